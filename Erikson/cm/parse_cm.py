@@ -1,9 +1,13 @@
-import csv
-import gzip
 import logging
 from logging.handlers import RotatingFileHandler
 import os
 from lxml import etree
+from common.delta import SnapshotIndex
+from common.metrics import Metrics
+from common.parser import Parser
+from common.sink import make_sink
+from common.split import read_split
+from common.stream import free_ancestors, free_element, open_input, source_name
 
 logger = logging.getLogger(__name__)
 
@@ -49,7 +53,17 @@ def init_my_logging():
     logger.addHandler(console)
 
 
-class Ericsson_CM:
+class Ericsson_CM(Parser):
+    version = 1
+    options = ('split_workers', 'pipeline')
+    # elements enclosing the containers, reopened at the start of every range of a split file
+    split_context = ('SubNetwork', 'MeContext', 'ManagedElement')
+
+    def __init__(self, output_format='csv', delta=None, **options):
+        super().__init__(output_format, **options)
+        # path of the snapshot index: only the containers changed since the previous dump are written,
+        # identified by their DN
+        self.delta = delta
 
     def get_tag_without_schema(self, elem):
         tag = elem.tag.split('}')[-1]
@@ -89,53 +103,49 @@ class Ericsson_CM:
                 continue
             data[class_file][-1].append((attribute, elem.text))
 
-    def read_xml(self, xml_filename, write_directory):
-        if xml_filename.split('.')[-1] == 'gz':
-            xml_filename = gzip.open(xml_filename)
-        logger.info(f'Working on {xml_filename}...')
-        context = etree.iterparse(xml_filename, events=("start", "end"))
-        file_name = xml_filename.split('/')[-1]
-        class_file = None
-        date_time = None
-        logger.info(f'start context')
-        list_data = []
-        data = {}
+    def read_xml(self, xml_filename, write_directory=None):
+        """
+        Yield one record per VsDataContainer, as soon as its attributes element is complete. Only end events
+        are handled, so the attributes are fully parsed whatever their depth, and every processed element is
+        freed with the processed siblings of its ancestors: memory follows the depth of the tree, not its size
+        """
+        file_name = source_name(xml_filename)
+        xml_filename = open_input(xml_filename, self.metrics)
+        logger.info(f'Working on {file_name}...')
+        # {*} matches whatever namespace URI the export binds to the xn prefix
+        context = etree.iterparse(xml_filename, events=('end',), tag=('{*}attributes', '{*}VsDataContainer'))
         for event, elem in context:
-            if event == 'start':
-                tag = self.get_tag_without_schema(elem)
-                if tag == 'VsDataContainer':
-                    data['id'] = elem.get('id')
-                    for el in elem:
-                        self.get_children(el, data)
-                        list_data.append(data)
-                        data = {}
-                        break
-
-
-            elif event == 'end':
-                if elem.tag == 'VsDataContainer':
-                    ...
-
-            elem.clear()
-        return list_data
+            if self.get_tag_without_schema(elem) == 'VsDataContainer':
+                free_element(elem)
+                free_ancestors(elem)
+                continue
+            container = elem.getparent()
+            if container is None or self.get_tag_without_schema(container) != 'VsDataContainer':
+                free_element(elem)
+                continue
+            data = {'id': container.get('id')}
+            if self.delta is not None:
+                data['DN'] = self.get_dn(container)
+            self.get_children(elem, data)
+            free_element(elem)
+            yield data
+
+    def get_dn(self, container):
+        # SubNetwork=...,MeContext=...,ManagedElement=...,VsDataContainer=..., from the ids of the ancestors
+        elements = [container, *container.iterancestors()]
+        return ','.join(f'{self.get_tag_without_schema(e)}={e.get("id")}' for e in reversed(elements)
+                        if e.get('id') is not None)
 
     def get_children(self, elem, data):
-        try:
-            for ele in elem:
-                if ele.text is None:
-                    return
-                tag = self.get_tag_without_schema(ele)
-                data[tag] = ele.text
-                if '\n' in ele.text:
-                    for el in ele:
-                        tag_el = self.get_tag_without_schema(el)
-                        data[tag_el] = el.text
-                        if '\n' in ele.text:
-                            for e in el:
-                                tag_e = self.get_tag_without_schema(e)
-                                data[tag_e] = e.text
-        except TypeError as ex:
-            print(ex)
+        # every element below attributes gives a column named after its tag: structures an empty one,
+        # leaves their text, repeated leaves (multi-valued attributes) their values joined with ';'
+        for child in elem.iterdescendants(tag=etree.Element):
+            tag = self.get_tag_without_schema(child)
+            if len(child):
+                data.setdefault(tag, '')
+                continue
+            text = (child.text or '').strip()
+            data[tag] = f'{data[tag]};{text}' if data.get(tag) else text
 
     def add_to_data_file_name(self, data, file_name, date_time):
         for d in data:
@@ -163,27 +173,35 @@ class Ericsson_CM:
             if file_name[:6] == 'vsData':
                 return file_name[6:]
 
-    def initialize_output(self, report_filename, fieldnames):
-        if not os.path.isfile(report_filename):
-            with open(report_filename, "w", newline="") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-
-    def add_data_to_csv(self, report_filename, data, fieldnames):
-        with open(report_filename, "a", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writerow(data)
-
     def run(self, file_name, write_directory):
-        list_data = self.read_xml(file_name, write_directory)
-        for n, data in enumerate(list_data, 1):
-            file_name = self.get_file_name(data)
-            write_result = f"{write_directory}/{file_name}.csv"
-            field_names = sorted([key for key in data.keys()], reverse=True)
-            self.check_data(data)
-            self.initialize_output(write_result, field_names)
-            self.add_data_to_csv(write_result, data, field_names)
-            logger.info(f"Added row {n} records to csv")
+        self.metrics = metrics = Metrics(source_name(file_name), pipelined=self.pipeline)
+        with make_sink(write_directory, self.output_format, metrics) as sink:
+            index = None
+            if self.delta is not None:
+                index = SnapshotIndex(self.delta, 'DN')
+            if self.split_workers:
+                records = read_split(self, 'read_xml', file_name, self.split_workers, 'VsDataContainer',
+                                     self.split_context)
+            else:
+                records = self.read_xml(file_name, write_directory)
+            for data in records:
+                with metrics.stage('transform'):
+                    file_name = self.get_file_name(data)
+                    self.check_data(data)
+                    if index is not None:
+                        data = index.get_delta(file_name, data)
+                    if data is None:
+                        continue
+                    field_names = sorted([key for key in data.keys()], reverse=True)
+                sink.write(file_name, field_names, [data], keys=('DN' if index is not None else 'id',))
+            if index is not None:
+                for file_name, data in index.removed():
+                    sink.write(file_name, sorted(data, reverse=True), [data], keys=('DN',))
+        if index is not None:
+            index.commit()
+        self.outputs = sink.outputs
+        metrics.finish()
+        return sink.rows_written
 
 
 
@@ -1,13 +1,34 @@
-import gzip
-import xml.etree.cElementTree as ET
-import csv
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+import sys
+from functools import lru_cache
+from lxml import etree
+from common.dimension import open_mo_run, write_dimension
+from common.layout import get_registry
+from common.metrics import Metrics
+from common.offsets import get_index_directory, open_selected
+from common.parser import Parser
+from common.rollup import make_rollup, parse_duration, parse_time
+from common.sink import make_sink
+from common.split import read_split
+from common.stream import free_element, open_input, source_name
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=65536)
+def parse_meas_obj(obj):
+    # an LDN is parsed once for all its measInfos; the dict is shared and must not be changed by callers
+    data = {}
+    for el in obj.split(','):
+        key = el.split('=')[0]
+        value = el.split('=')[1]
+        # the same LDN parts repeat in every object of the file: they are interned
+        data.setdefault(sys.intern(key), sys.intern(value))
+    return data
+
+
 def init_my_logging():
     """
     Configuring logging for a SON-like appearance when running locally
@@ -36,164 +57,241 @@ def init_my_logging():
     logger.addHandler(console)
 
 
-class Ericsson_PM:
+class Ericsson_PM(Parser):
+    version = 1
+    options = ('counters', 'measurements', 'rollup', 'mo_ids', 'split_workers', 'offset_index', 'pipeline')
+    time_columns = ('Begin time', 'End Time')
+
+    def __init__(self, output_format='csv', wide=False, **options):
+        super().__init__(output_format, **options)
+        # wide: one row per measObjLdn with a column per counter instead of one row per counter value
+        self.wide = wide
+
     def get_tag(self, elem):
         return elem.tag.split("}")[-1]
 
-    def initialize_output(self, report_filename, fieldnames):
-        if not os.path.isfile(report_filename):
-            with open(report_filename, "w", newline="") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
+    def get_header(self, data):
+        return {
+            'Begin time': data.get('begin_time'),
+            'End Time': data.get('endTime'),
+            'Duration': data.get('duration'),
+            'Rep period': data.get('repPeriod'),
+        }
 
-    def get_data(self, path: list):
+    def get_object(self, ldn, ids, number):
+        return self.get_meas_obj(ldn) if ids is None else {'MO_ID': ids[number]}
+
+    def get_records(self, data, ids=None):
+        """
+        Long-format records of one measInfo: an (object number, counter, index, value) tuple per value, one
+        per element with its index for PDF arrays. The header values and the LDN keys of each object are
+        kept once per measInfo, rows are only built from them by iter_rows while they are written
+        """
+        meas_types = data.get('measTypes', {})
+        objects = []
+        records = []
+        for number, (ldn, results) in enumerate(data['measObjLdn']):
+            objects.append(self.get_object(ldn, ids, number))
+            for p, value in results:
+                counter = meas_types.get(p)
+                if value is not None and ',' in value:
+                    records.extend((number, counter, index, v) for index, v in enumerate(value.split(',')))
+                else:
+                    records.append((number, counter, None, value))
+        return objects, records
+
+    def get_record_columns(self, data, objects, records):
+        columns = dict.fromkeys(self.get_header(data))
+        for obj in objects:
+            columns.update(dict.fromkeys(obj))
+        columns.update(dict.fromkeys(counter for _, counter, _, _ in records))
+        if any(index is not None for _, _, index, _ in records):
+            columns['index'] = None
+        return list(columns)
+
+    def iter_rows(self, data, objects, records):
+        header = self.get_header(data)
+        for number, counter, index, value in records:
+            row = {**header, **objects[number]}
+            row.setdefault(counter, value)
+            if index is not None:
+                row.setdefault('index', index)
+            yield row
+
+    def get_data_wide(self, data, ids=None):
+        meas_types = data.get('measTypes', {})
+        header = self.get_header(data)
         result_list = []
-        for data in path:
-            for mang in data.get('measObjLdn'):
-                key = list(mang.keys())[0]
-                value = list(mang.values())
-                for val in value:
-                    for v in val:
-                        key_ind = list(v.keys())[0]
-                        value_ind = list(v.values())[0]
-                        if self.check_value(value_ind):
-                            for index, value in enumerate(value_ind.split(',')):
-                                xpath = {}
-                                key_meas_type = self.get_meas_type(key_ind,data)
-                                result_list.append(self.set_value(data, xpath, key,key_meas_type, index, value))
-                        else:
-                            xpath = {}
-                            key_meas_type = self.get_meas_type(key_ind,data)
-                            result_list.append(self.set_value(data, xpath, key ,key_meas_type,None,value_ind))
-
-                        # xpath.update(self.get_meas_type(key_ind,data.get('measTypes',[]),value_ind))
-                        # меастип приравнивается к валуе
-                        # для каждого валуе свой индекс если значений больше 1
-
-                        # result_list.extend(xpath)
-
+        for number, (ldn, results) in enumerate(data.get('measObjLdn')):
+            row = dict(header)
+            row.update(self.get_object(ldn, ids, number))
+            for p, value in results:
+                row[meas_types.get(p)] = value
+            result_list.append(row)
         return result_list
 
-
-
-    def check_value(self,value):
-        if len(value.split(',')) > 1:
-            return True
-        return False
-    def set_value(self,data,xpath,key,key_meas_type,index,value):
-        xpath.setdefault('file_name', data.get('files_name'))
-        xpath.setdefault('Begin time', data.get('begin_time'))
-        xpath.setdefault('End Time', data.get('endTime'))
-        xpath.setdefault('Duration', data.get('duration'))
-        xpath.setdefault('Rep period', data.get('repPeriod'))
-        xpath.update(self.get_meas_obj(key))
-        xpath.setdefault(key_meas_type,value)
-        if index is not None:
-            xpath.setdefault('index', index)
-        # xpath.setdefault('value', value)
-        return xpath
-
-    def get_meas_type(self,key,data):
-        for da in data.get('measTypes',[]):
-            if value := da.get(key,False):
-                return value
-
-
-
     def get_file_name(self, file_name: str):
         file_name = file_name.split('=')[-1]
         return file_name
 
-    def parse_data(self, xml_filename):
-        if xml_filename.split('.')[-1] == 'gz':
-            xml_filename = gzip.open(xml_filename)
+    def parse_data(self, xml_filename, write_directory=None):
+        if self.offset_index and self.measurements is not None:
+            xml_filename = open_selected(xml_filename, lambda keys: self.is_selected(keys.get('measInfoId')),
+                                         'measInfo', ('measData',), ('measInfoId',),
+                                         get_index_directory(self.offset_index, write_directory))
+        xml_filename = open_input(xml_filename, self.metrics)
         logger.info(f'Working on {xml_filename}...')
-        tree = ET.parse(xml_filename)
-        context = tree.getroot()
-        logger.info(f'start context')
-        list_context = context.findall(".//{http://www.3gpp.org/ftp/specs/archive/32_series/32.435#measCollec}measInfo")
-        results_data = []
-        time = context.find(".//{http://www.3gpp.org/ftp/specs/archive/32_series/32.435#measCollec}measCollec")
-        begin_time: str = time.get('beginTime')
         namespace = {
             'ns': 'http://www.3gpp.org/ftp/specs/archive/32_series/32.435#measCollec'
         }
-
-        for n, elem in enumerate(list_context):
-            data = {}
-            data.setdefault('begin_time', begin_time)
-            files_name: str = self.get_file_name(elem.get('measInfoId'))
-            # Извлечение granPeriod
-            data.setdefault('files_name', files_name)
-            gran_period_element = elem.find('.//ns:granPeriod', namespaces=namespace)
-            data.setdefault('endTime', gran_period_element.get('endTime'))
-            data.setdefault('duration', gran_period_element.get('duration'))
-
-            # Извлечение repPeriod
-            rep_period_element = elem.find('.//ns:repPeriod', namespaces=namespace)
-            data.setdefault('repPeriod', rep_period_element.get('duration'))
-
-            # Извлечение measTypes
-            meas_types_element = elem.findall('.//ns:measType', namespaces=namespace)
-            data.setdefault('measTypes', [{i.get('p'): i.text.strip()} for i in meas_types_element])
-
-            # Извлечение measValue
-            meas_value_element = elem.findall('.//ns:measValue', namespaces=namespace)
-            data['measObjLdn'] = []
-            for el in meas_value_element:
-                meas_results = el.findall('.//ns:r', namespaces=namespace)
-                data['measObjLdn'].append({el.get('measObjLdn'): [{i.get('p'): i.text} for i in meas_results]})
-            results_data.append(data)
-
-        return results_data
-
-    def get_meas_obj(self, obj):
-        data = {}
-        for el in obj.split(','):
-            key = el.split('=')[0]
-            value = el.split('=')[1]
-            data.setdefault(key, value)
-        return data
-
-    def sorted_list_data(self, list_data):
+        # measValues are handled and freed one by one, so only their values are buffered, not their elements
+        context = etree.iterparse(xml_filename, events=('end',),
+                                  tag=(f"{{{namespace['ns']}}}measCollec", f"{{{namespace['ns']}}}measValue",
+                                       f"{{{namespace['ns']}}}measInfo"))
+        logger.info(f'start context')
+        begin_time = None
+        # header of the measInfo being parsed, False when it is not selected
+        data = None
+
+        for event, elem in context:
+            tag = self.get_tag(elem)
+            if tag == 'measCollec':
+                # fileHeader carries beginTime, the fileFooter measCollec only endTime
+                begin_time = begin_time or elem.get('beginTime')
+                continue
+            if tag == 'measValue':
+                # the measInfo header precedes its measValues and is read before the first one is freed
+                if data is None:
+                    data = self.get_meas_info(elem.getparent(), begin_time, namespace) or False
+                if data:
+                    meas_types = data['measTypes']
+                    meas_results = elem.findall('.//ns:r', namespaces=namespace)
+                    # (measObjLdn, [(p, value), ...]) pairs rather than a dict per value
+                    data['measObjLdn'].append((elem.get('measObjLdn'), [(i.get('p'), i.text) for i in meas_results
+                                                                       if self.counters is None or i.get('p') in meas_types]))
+                free_element(elem)
+                continue
+            if data is None:
+                data = self.get_meas_info(elem, begin_time, namespace) or False
+            free_element(elem)
+            if data:
+                yield data
+            data = None
+
+    def is_selected(self, meas_info_id):
+        # measurements name measInfoIds or the tables they are written to
+        return self.measurements is None or bool({meas_info_id, self.get_file_name(meas_info_id or '')} &
+                                                 self.measurements)
+
+    def get_meas_info(self, elem, begin_time, namespace):
+        """
+        Header of a measInfo with an empty measObjLdn list, None when the measurement or counter selection drops it
+        """
+        files_name: str = self.get_file_name(elem.get('measInfoId'))
+        if not self.is_selected(elem.get('measInfoId')):
+            return None
+        meas_types_element = elem.findall('.//ns:measType', namespaces=namespace)
+        meas_types = {i.get('p'): i.text.strip() for i in meas_types_element}
+        if self.counters is not None:
+            meas_types = {p: name for p, name in meas_types.items() if name in self.counters}
+            if not meas_types:
+                return None
         data = {}
-        for d in list_data:
-            file_name = d.get('file_name')
-            if file_name not in data:
-                del d['file_name']
-                data[file_name] = [d]
-            else:
-                del d['file_name']
-                data.get(file_name).append(d)
+        data.setdefault('begin_time', begin_time)
+        # Извлечение granPeriod
+        data.setdefault('files_name', files_name)
+        gran_period_element = elem.find('.//ns:granPeriod', namespaces=namespace)
+        data.setdefault('endTime', gran_period_element.get('endTime'))
+        data.setdefault('duration', gran_period_element.get('duration'))
+
+        # Извлечение repPeriod
+        rep_period_element = elem.find('.//ns:repPeriod', namespaces=namespace)
+        data.setdefault('repPeriod', rep_period_element.get('duration'))
+
+        # Извлечение measTypes
+        data.setdefault('measTypes', meas_types)
+        data['measObjLdn'] = []
         return data
 
-    def get_filed_names(self, value):
-        filed_names = []
-        for data in value:
-            for k,v in data.items():
-                filed_names.append(k)
-        return list(set(filed_names))
-
-
-    def add_data_to_csv(self, report_filename, data, fieldnames):
-        with open(report_filename, "a", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            for d in data:
-                writer.writerow(d)
+    def get_meas_obj(self, obj):
+        return parse_meas_obj(obj)
+
+    def get_key_columns(self, data):
+        # LDN keys of the measInfo objects, indexed by the sinks supporting it
+        if self.mo_ids:
+            return ['MO_ID']
+        keys = {}
+        for ldn, _ in data['measObjLdn']:
+            keys.update(self.get_meas_obj(ldn))
+        return list(keys)
+
+    def get_rop_start(self, data):
+        # beginTime of the file header, or the start of the granPeriod
+        if data.get('begin_time'):
+            return parse_time(data['begin_time'])
+        return parse_time(data['endTime']) - parse_duration(data['duration'])
+
+    def add_rollup(self, rollup, data):
+        start = self.get_rop_start(data)
+        meas_types = data['measTypes']
+        for ldn, results in data['measObjLdn']:
+            rollup.add_row(data['files_name'], ldn, start, {meas_types[p]: v for p, v in results if p in meas_types})
 
     def run(self, xml_file_names, write_directory):
         logger.info(f"Fetching Schema...")
-        logger.info(f"Working on {len(xml_file_names)} files in ...")
-        path = self.parse_data(xml_file_names)
-        list_data = self.get_data(path)
-        list_data = self.sorted_list_data(list_data)
-        for file_name, value in list_data.items():
-            fieldnames = sorted(self.get_filed_names(value))
-            # value.sort(key=lambda x : x.get('index'))
-            write_result = f"{write_directory}/{file_name}.csv"
-            self.initialize_output(write_result, fieldnames)
-            self.add_data_to_csv(write_result, value, fieldnames)
-            logger.info(f"Added row {len(value)} records to csv")
+        logger.info(f"Working on {source_name(xml_file_names)}...")
+        self.metrics = metrics = Metrics(source_name(xml_file_names), pipelined=self.pipeline)
+        layouts = get_registry(write_directory)
+        rollup = make_rollup(write_directory, self.rollup)
+        registry = open_mo_run(write_directory, self.output_format) if self.mo_ids else None
+        layout = 'ericsson_pm_wide' if self.wide else 'ericsson_pm'
+        if self.mo_ids:
+            layout += '_ids'
+        with make_sink(write_directory, self.output_format, metrics) as sink:
+            if self.split_workers:
+                records = read_split(self, 'parse_data', xml_file_names, self.split_workers, 'measInfo',
+                                     ('measData',))
+            else:
+                records = self.parse_data(xml_file_names, write_directory)
+            for path in records:
+                counters = path['measTypes'].values()
+                keys = self.get_key_columns(path)
+                ids = None
+                if registry is not None:
+                    with metrics.stage('transform'):
+                        ids, new = registry.get_ids([ldn for ldn, _ in path['measObjLdn']])
+                    write_dimension(sink, new, self.get_meas_obj)
+                if rollup is not None:
+                    with metrics.stage('rollup'):
+                        self.add_rollup(rollup, path)
+                if self.wide:
+                    with metrics.stage('transform'):
+                        value = self.get_data_wide(path, ids)
+                    if value:
+                        # header fields, then LDN keys and counters in document order
+                        fieldnames = layouts.get_columns(
+                            layout, path['files_name'], counters,
+                            lambda: dict.fromkeys(k for d in value for k in d))
+                        sink.write(path['files_name'], fieldnames, value, keys=keys, times=self.time_columns)
+                    continue
+                with metrics.stage('transform'):
+                    objects, records = self.get_records(path, ids)
+                    fieldnames = layouts.get_columns(
+                        layout, path['files_name'], counters,
+                        lambda: sorted(self.get_record_columns(path, objects, records)))
+                if records:
+                    sink.write(path['files_name'], fieldnames, self.iter_rows(path, objects, records),
+                               keys=keys, times=self.time_columns)
+            if rollup is not None:
+                with metrics.stage('rollup'):
+                    rollup.close()
+        if registry is not None:
+            # the MO rows of the run are on disk
+            registry.commit()
+        layouts.save()
+        self.outputs = sink.outputs
+        metrics.finish()
+        return sink.rows_written
 
 
 
@@ -1,9 +1,17 @@
-import csv
-import gzip
 import logging
 from logging.handlers import RotatingFileHandler
 import os
-import xml.etree.ElementTree as ET
+from functools import lru_cache
+from lxml import etree
+import numpy as np
+from common.dimension import open_mo_run, write_dimension
+from common.layout import get_registry
+from common.metrics import Metrics
+from common.offsets import get_index_directory, open_selected
+from common.parser import Parser
+from common.rollup import make_rollup, parse_duration, parse_time
+from common.sink import make_sink
+from common.stream import free_element, open_input, source_name
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +29,19 @@ logger = logging.getLogger(__name__)
 #                'M8011C95']
 
 
+@lru_cache(maxsize=65536)
+def parse_ldn(meas_obj_ldn):
+    # the same objects come back in every measInfo and file: the parsed dict is shared, callers must not change it
+    ldn = {}
+    for value in meas_obj_ldn.split(':')[1].split(','):
+        key = value.split('=')
+        if len(key) > 1:
+            ldn[key[0].strip()] = key[1].strip()
+        else:
+            ldn[key[0].strip()] = ''
+    return ldn
+
+
 def init_my_logging():
     """
     Configuring logging for a SON-like appearance when running locally
@@ -49,7 +70,10 @@ def init_my_logging():
     logger.addHandler(console)
 
 
-class Huawei_PM:
+class Huawei_PM(Parser):
+    version = 1
+    options = ('counters', 'measurements', 'rollup', 'mo_ids', 'offset_index', 'pipeline')
+    header_columns = ('duration', 'endTime', 'repPeriod')
 
     def get_tag_without_schema(self, elem):
         tag = elem.tag.split('}')[-1]
@@ -87,20 +111,24 @@ class Huawei_PM:
             print(ex)
 
     def read_xml(self, xml_filename, write_directory):
-        if xml_filename.split('.')[-1] == 'gz':
-            xml_filename = gzip.open(xml_filename)
+        if self.offset_index and self.measurements is not None:
+            xml_filename = open_selected(
+                xml_filename, lambda keys: self.is_selected_key(keys.get('measInfoId'), keys.get('measObjLdn')),
+                'measInfo', ('measData',), ('measInfoId', 'measObjLdn'),
+                get_index_directory(self.offset_index, write_directory))
+        xml_filename = open_input(xml_filename, self.metrics)
         logger.info(f'Working on {xml_filename}...')
-        tree = ET.parse(xml_filename)
-        context = tree.getroot()
-        logger.info(f'start context')
-        list_context = context.findall(".//{http://latest/nmc-omc/cmNrm.doc#measCollec}measInfo")
-        results_data = []
         namespace = {
             'ns': 'http://latest/nmc-omc/cmNrm.doc#measCollec'
         }
+        context = etree.iterparse(xml_filename, events=('end',), tag=f"{{{namespace['ns']}}}measInfo")
+        logger.info(f'start context')
         data = {}
-        for n, elem in enumerate(list_context):
-            # data['measInfoId'] = elem.get('measInfoId')
+        for event, elem in context:
+            if not self.is_selected(elem, namespace):
+                free_element(elem)
+                continue
+            data['measInfoId'] = elem.get('measInfoId')
 
             # Извлечение granPeriod
             gran_period_element = elem.find('.//ns:granPeriod', namespaces=namespace)
@@ -114,6 +142,14 @@ class Huawei_PM:
             # Извлечение measTypes
             meas_types_element = elem.find('.//ns:measTypes', namespaces=namespace)
             data['measTypes'] = meas_types_element.text.strip().split()
+            index = None
+            if self.counters is not None:
+                index = [i for i, meas_type in enumerate(data['measTypes']) if meas_type in self.counters]
+                if not index:
+                    free_element(elem)
+                    data = {}
+                    continue
+                data['measTypes'] = [data['measTypes'][i] for i in index]
 
             # Извлечение measValue
             meas_value_element = elem.findall('.//ns:measValue', namespaces=namespace)
@@ -122,72 +158,115 @@ class Huawei_PM:
             for el in meas_value_element:
                 data['measObjLdn'].append(el.get('measObjLdn'))
                 meas_results = el.find('.//ns:measResults', namespaces=namespace)
-                data['measResults'].append(
-                    [{k: v} for k, v in zip(data.get('measTypes'), meas_results.text.strip().split())])
-            del data['measTypes']
-            results_data.append(data)
+                text = meas_results.text or '' if meas_results is not None else ''
+                if index is not None:
+                    values = text.split()
+                    text = ' '.join(values[i] if i < len(values) else 'NIL' for i in index)
+                data['measResults'].append(text)
+            free_element(elem)
+            if data['measResults']:
+                yield data
             data = {}
 
-        return results_data
+    def is_selected(self, elem, namespace):
+        if self.measurements is None or elem.get('measInfoId') in self.measurements:
+            return True
+        meas_value = elem.find('ns:measValue', namespaces=namespace)
+        return self.is_selected_key(None, None if meas_value is None else meas_value.get('measObjLdn'))
+
+    def is_selected_key(self, meas_info_id, meas_obj_ldn):
+        # measurements may also name the object class the rows are written to, from the first measObjLdn
+        if self.measurements is None or meas_info_id in self.measurements:
+            return True
+        return meas_obj_ldn is not None and meas_obj_ldn.split(':')[0].split('/')[1] in self.measurements
 
     def check_data(self, result):
         for data in result: ...
 
-    def initialize_output(self, report_filename, fieldnames):
-        if not os.path.isfile(report_filename):
-            with open(report_filename, "w", newline="") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-
-    def get_data(self, data):
-        list_data = []
-
-        for n, value in enumerate(data.get('measResults', [])):
-            d = {}
-            d['duration'] = data.get('duration')
-            d['endTime'] = data.get('endTime')
-            d['repPeriod'] = data.get('repPeriod')
-            # d['measObjLdn'] = data.get('measObjLdn')[n].split(':')[1]
-            for da in value:
-                d.update(da)
-            lst_measObjLdn = data.get('measObjLdn')[n].split(':')[1]
-            for value in lst_measObjLdn.split(','):
-                key = value.split('=')
-                if len(key) > 1:
-                    d[key[0].strip()] = key[1].strip()
-                else:
-                    d[key[0].strip()] = ''
-            list_data.append(d)
-        return list_data
-
-
-
-    def add_data_to_csv(self, report_filename, data, fieldnames):
-        with open(report_filename, "a", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writerow(data)
-
-    def check_file(self, file_name, directory):
-        filepath = os.path.join(directory, file_name + '.csv')
-        if os.path.isfile(filepath):
-            return True
-        else:
-            return False
+    def get_ldn(self, meas_obj_ldn):
+        return parse_ldn(meas_obj_ldn)
+
+    def to_float(self, value):
+        try:
+            return float(value)
+        except ValueError:
+            return np.nan
+
+    def decode_meas_results(self, meas_results, width):
+        """
+        Decode all measResults texts of one measInfo into a float array of objects x counters,
+        empty, missing and NIL values become NaN
+        """
+        tokens = []
+        for text in meas_results:
+            values = text.split()
+            if len(values) != width:
+                values = (values + ['nan'] * width)[:width]
+            tokens.extend(values)
+        tokens = np.array(tokens, dtype=str)
+        tokens = np.where(tokens == 'NIL', 'nan', tokens)
+        try:
+            values = tokens.astype(np.float64)
+        except ValueError:
+            values = np.array([self.to_float(t) for t in tokens.tolist()], dtype=np.float64)
+        return values.reshape(len(meas_results), width)
+
+    def get_data_columns(self, data, ids=None):
+        values = self.decode_meas_results(data['measResults'], len(data['measTypes']))
+        count = len(values)
+        columns = {
+            'duration': [data.get('duration')] * count,
+            'endTime': [data.get('endTime')] * count,
+            'repPeriod': [data.get('repPeriod')] * count,
+        }
+        for i, meas_type in enumerate(data['measTypes']):
+            columns[meas_type] = values[:, i]
+        if ids is not None:
+            columns['MO_ID'] = ids
+            return columns
+        ldns = [self.get_ldn(ldn) for ldn in data['measObjLdn']]
+        for key in dict.fromkeys(k for ldn in ldns for k in ldn):
+            columns[key] = [ldn.get(key, '') for ldn in ldns]
+        return columns
 
     def run(self, path_to_file, write_directory):
-        result = sorted(self.read_xml(path_to_file, write_directory),key=lambda x : -len(x.get('measResults')[0]))
+        self.metrics = metrics = Metrics(source_name(path_to_file), pipelined=self.pipeline)
+        result = self.read_xml(path_to_file, write_directory)
         # self.check_data(result)
-        for n, data in enumerate(result, 1):
-            file_name = data['measObjLdn'][0].split(':')[0].split('/')[1]
-            # data['measObjLdn'] = data['measObjLdn'].split(':')[1].split(',')
-            write_result = f"{write_directory}/{file_name}.csv"
-            # fieldnames = [key for key in data.keys()]
-            data_list = self.get_data(data)
-            for d in data_list:
-                fieldnames = sorted([key for key in d.keys()],reverse=True)
-                self.initialize_output(write_result, fieldnames=fieldnames)
-                self.add_data_to_csv(write_result, d, fieldnames=fieldnames)
-            logger.info(f"Added row {n} records to csv")
+        layouts = get_registry(write_directory)
+        rollup = make_rollup(write_directory, self.rollup)
+        registry = open_mo_run(write_directory, self.output_format) if self.mo_ids else None
+        with make_sink(write_directory, self.output_format, metrics) as sink:
+            for data in result:
+                with metrics.stage('transform'):
+                    file_name = data['measObjLdn'][0].split(':')[0].split('/')[1]
+                    # data['measObjLdn'] = data['measObjLdn'].split(':')[1].split(',')
+                    ids, new = registry.get_ids(data['measObjLdn']) if registry is not None else (None, None)
+                    columns = self.get_data_columns(data, ids)
+                    fieldnames = layouts.get_columns('huawei_pm_ids' if self.mo_ids else 'huawei_pm',
+                                                     data['measInfoId'], data['measTypes'],
+                                                     lambda: sorted(columns, reverse=True))
+                    counters = set(data['measTypes'])
+                    keys = [k for k in columns if k not in counters and k not in self.header_columns]
+                write_dimension(sink, new, self.get_ldn)
+                sink.write_columns(file_name, fieldnames, columns, keys=keys, times=('endTime',),
+                                   measurement=data['measInfoId'])
+                if rollup is not None:
+                    with metrics.stage('rollup'):
+                        start = parse_time(data['endTime']) - parse_duration(data['duration'])
+                        # one rollup per measInfo: the object tables would be as sparse as their union of counters
+                        rollup.add(f"{file_name}.{data['measInfoId']}", data['measObjLdn'], start,
+                                   {m: columns[m] for m in data['measTypes']})
+            if rollup is not None:
+                with metrics.stage('rollup'):
+                    rollup.close()
+        if registry is not None:
+            # the MO rows of the run are on disk
+            registry.commit()
+        layouts.save()
+        self.outputs = sink.outputs
+        metrics.finish()
+        return sink.rows_written
 
 
 
@@ -1,10 +1,15 @@
-import csv
-import gzip
 from collections import deque
 import logging
 from logging.handlers import RotatingFileHandler
 import os
 from lxml import etree
+from common.delta import SnapshotIndex
+from common.metrics import Metrics
+from common.offsets import get_index_directory, open_selected
+from common.parser import Parser
+from common.sink import make_sink
+from common.split import read_split
+from common.stream import free_element, open_input, source_name
 
 
 logger = logging.getLogger(__name__)
@@ -76,127 +81,153 @@ def init_my_logging():
     logger.addHandler(console)
 
 
-class Nokia_CM:
+class ClassBatches:
+    """
+    Rows waiting to be written, partitioned by managedObject class. The columns of a class are collected
+    as its rows come in, a class is written once it has flush_rows rows, and all classes once the buffered
+    rows take about flush_bytes of memory. flush() writes whatever is left, e.g. at the end of the file
+    """
+    # approximate memory of a buffered value besides its characters: str object and dict entry
+    value_overhead = 100
+
+    def __init__(self, sink, flush_rows=1000, flush_bytes=16 * 1024 * 1024):
+        self.sink = sink
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self._rows = {}
+        self._columns = {}
+        self._class_bytes = {}
+        self._bytes = 0
+
+    def add(self, class_name, row):
+        rows = self._rows.get(class_name)
+        if rows is None:
+            rows = self._rows[class_name] = []
+            self._columns[class_name] = {}
+            self._class_bytes[class_name] = 0
+        rows.append(row)
+        columns = self._columns[class_name]
+        if len(columns) < len(row) or not columns.keys() >= row.keys():
+            columns.update(dict.fromkeys(row))
+        size = sum(len(value) for value in row.values() if value) + len(row) * self.value_overhead
+        self._class_bytes[class_name] += size
+        self._bytes += size
+        if len(rows) >= self.flush_rows:
+            self.flush_class(class_name)
+        elif self._bytes >= self.flush_bytes:
+            self.flush()
+
+    def get_fieldnames(self, class_name):
+        columns = self._columns[class_name]
+        return ['FileName', 'dateTime'] + sorted(c for c in columns if c not in ('FileName', 'dateTime'))
+
+    def flush_class(self, class_name):
+        rows = self._rows[class_name]
+        if rows:
+            self.sink.write(class_name, self.get_fieldnames(class_name), rows, keys=('distName',),
+                            times=('dateTime',))
+            self._bytes -= self._class_bytes[class_name]
+            self._class_bytes[class_name] = 0
+            self._rows[class_name] = []
+
+    def flush(self):
+        for class_name in self._rows:
+            self.flush_class(class_name)
+
+
+class Nokia_CM(Parser):
+    version = 1
+    options = ('split_workers', 'offset_index', 'pipeline')
+
+    def __init__(self, output_format='csv', delta=None, classes=None, **options):
+        super().__init__(output_format, **options)
+        # path of the snapshot index: only the MOs changed since the previous dump are written
+        self.delta = delta
+        # managedObject classes to keep, None keeps everything
+        self.classes = set(classes) if classes else None
+        if self.delta is not None and self.classes is not None:
+            raise ValueError('A delta compares whole dumps: classes cannot be selected')
 
     def get_tag_without_schema(self, elem):
         tag = elem.tag.split('}')[-1]
         return tag
 
-    def add_data(self, data, elem):
-        lst = []
-        for e in elem.attrib:
-            if elem.attrib.get('class') not in data:
-                data[elem.attrib.get('class')] = []
-            attribute = elem.attrib.get(e)
-            if e == 'class':
-                continue
-            lst.append((e, attribute))
-        data[elem.attrib.get('class')].append(lst)
-
-    def add_data_list(self, data, elem, attribute, class_file):
-        text = []
+    def get_list_value(self, elem):
+        # plain lists are joined with ';', items of structured lists as name=value pairs
+        values = []
         for el in elem:
-            if self.get_tag_without_schema(el):
-                if el.text is None:
-                    continue
-                text.append(el.text)
-        if text:
-            text = ';'.join(text)
-        else:
-            text = ''
-        data[class_file][-1].append((attribute, text))
-
-    def add_data_class(self, data, elem, class_file):
-        for e in elem.attrib:
-            attribute = elem.attrib.get(e)
-            if elem.text == 'name':
-                continue
-            if self.get_tag_without_schema(elem) == 'list':
-                self.add_data_list(data, elem, attribute, class_file)
-                continue
-            data[class_file][-1].append((attribute, elem.text))
-
-    def read_xml(self, xml_filename, write_directory):
-        lst = []
-        if xml_filename.split('.')[-1] == 'gz':
-            xml_filename = gzip.open(xml_filename)
-        data = {}
-        logger.info(f'Working on {xml_filename}...')
-        context = etree.iterparse(xml_filename, events=("start", "end"))
-        file_name = xml_filename.split('/')[-1]
-        class_file = None
+            if len(el):
+                values.append(','.join(f"{p.get('name')}={(p.text or '').strip()}" for p in el))
+            elif el.text is not None:
+                values.append(el.text.strip())
+        return ';'.join(values)
+
+    def get_row(self, elem, file_name, date_time):
+        row = {'FileName': file_name, 'dateTime': date_time}
+        row.update((k, v) for k, v in elem.attrib.items() if k != 'class')
+        for child in elem:
+            tag = self.get_tag_without_schema(child)
+            if tag == 'p':
+                row[child.get('name')] = (child.text or '').strip()
+            elif tag == 'list':
+                row[child.get('name')] = self.get_list_value(child)
+        return row
+
+    def read_xml(self, xml_filename, write_directory=None):
+        """
+        Yield (class, row) for every managedObject once it is complete: only end events are handled,
+        so the p and list children are always fully parsed
+        """
+        file_name = source_name(xml_filename)
+        if self.offset_index and self.classes is not None:
+            xml_filename = open_selected(xml_filename, lambda keys: keys.get('class') in self.classes,
+                                         'managedObject', (), ('class',),
+                                         get_index_directory(self.offset_index, write_directory))
+        xml_filename = open_input(xml_filename, self.metrics)
+        logger.info(f'Working on {file_name}...')
+        context = etree.iterparse(xml_filename, events=('end',), tag=('{*}log', '{*}managedObject'))
         date_time = None
-        logger.info(f'start context')
         for event, elem in context:
-            try:
-                if event == 'start':
-                    if elem.attrib:
-                        class_file = class_file if elem.attrib.get('class') is None else elem.attrib.get('class')
-                        date_time = date_time if elem.attrib.get('dateTime') is None else elem.attrib.get(
-                            'dateTime')
-                        if class_file is None:
-                            continue
-                        if 'class' in elem.attrib:
-                            self.add_data(data, elem)
-
-                        else:
-                            self.add_data_class(data, elem, class_file)
-
-                if event == 'end':
-                    if len(data) > 1:
-                        for n, k in enumerate(data):
-                            if n == 0:
-                                fieldnames = ['FileName', 'dateTime'] + self.get_fieldnames(data[k])
-                                if not self.check_file(k, write_directory):
-                                    self.initialize_output(
-                                        f'{write_directory}/{k}.csv',
-                                        fieldnames)
-                                self.add_to_data_file_name(data[k], file_name, date_time)
-                                self.add_data_to_csv(data[k],
-                                                     f'{write_directory}/{k}.csv',
-                                                     fieldnames)
-                                del data[k]
-                                break
-                    elem.clear()
-            except Exception as ex:
-                print(ex)
-                break
-        return data
-
-    def add_to_data_file_name(self, data, file_name, date_time):
-        for d in data:
-            d.insert(0, ('dateTime', date_time))
-            d.insert(0, ('FileName', file_name))
-
-    def check_file(self, file_name, directory):
-        filepath = os.path.join(directory, file_name + '.csv')
-        if os.path.isfile(filepath):
-            return True
-        else:
-            return False
-
-    def get_fieldnames(self, spisok):
-        lst = []
-        for name in spisok:
-            name = [i[0] for i in name]
-            lst.extend(name)
-        return sorted(list(set(lst)))
-
-    def initialize_output(self, report_filename, fieldnames):
-        with open(report_filename, "w", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-    def add_data_to_csv(self, path, report_filename, fieldnames):
-        with open(report_filename, "a", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            for p in path:
-                p = dict(p)
-                writer.writerow(p)
-            logger.info(f"Added row {len(path)} records to csv")
+            if self.get_tag_without_schema(elem) == 'log':
+                date_time = elem.get('dateTime') or date_time
+                continue
+            if self.classes is not None and elem.get('class') not in self.classes:
+                free_element(elem)
+                continue
+            row = self.get_row(elem, file_name, date_time)
+            class_file = elem.get('class')
+            free_element(elem)
+            yield class_file, row
 
     def run(self, file_name, write_directory):
-        self.read_xml(file_name, write_directory)
+        self.metrics = metrics = Metrics(source_name(file_name), pipelined=self.pipeline)
+        with make_sink(write_directory, self.output_format, metrics) as sink:
+            batches = ClassBatches(sink)
+            index = None
+            if self.delta is not None:
+                index = SnapshotIndex(self.delta, 'distName', context=('FileName', 'dateTime'))
+            if self.split_workers:
+                records = read_split(self, 'read_xml', file_name, self.split_workers, 'managedObject')
+            else:
+                records = self.read_xml(file_name, write_directory)
+            for class_file, row in records:
+                if index is not None:
+                    with metrics.stage('transform'):
+                        row = index.get_delta(class_file, row)
+                    if row is None:
+                        continue
+                batches.add(class_file, row)
+            if index is not None:
+                for class_file, row in index.removed():
+                    batches.add(class_file, row)
+            # every class is written at the end of the file, the last one included
+            batches.flush()
+        # the new snapshot is only kept once the delta is written
+        if index is not None:
+            index.commit()
+        self.outputs = sink.outputs
+        metrics.finish()
+        return sink.rows_written
 
 
 if __name__ == '__main__':
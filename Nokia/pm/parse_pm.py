@@ -1,9 +1,16 @@
-import csv
-import gzip
 import logging
 from logging.handlers import RotatingFileHandler
 import os
-import xml.etree.ElementTree as ET
+from functools import lru_cache
+from lxml import etree
+from common.dimension import open_mo_run, write_dimension
+from common.layout import get_registry
+from common.metrics import Metrics
+from common.offsets import get_index_directory, open_selected
+from common.parser import Parser
+from common.rollup import make_rollup, parse_time
+from common.sink import make_sink
+from common.stream import free_element, open_input, source_name
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +28,17 @@ logger = logging.getLogger(__name__)
 #                'M8011C95']
 
 
+@lru_cache(maxsize=65536)
+def parse_dn(mo_dn):
+    # PLMN-PLMN/MRBTS-1/LNBTS-1, with the DNs of an MO joined by ', ': {'PLMN': 'PLMN', 'MRBTS': '1', ...}
+    components = {}
+    for dn in mo_dn.split(', '):
+        for part in dn.split('/'):
+            name, _, value = part.partition('-')
+            components.setdefault(name, value)
+    return components
+
+
 def init_my_logging():
     """
     Configuring logging for a SON-like appearance when running locally
@@ -49,7 +67,10 @@ def init_my_logging():
     logger.addHandler(console)
 
 
-class Nokia_PM:
+class Nokia_PM(Parser):
+    version = 1
+    options = ('counters', 'measurements', 'rollup', 'mo_ids', 'offset_index', 'pipeline')
+    header_columns = ('MO_DN', 'MO_ID', 'startTime', 'interval')
 
     def get_tag_without_schema(self, elem):
         tag = elem.tag.split('}')[-1]
@@ -69,65 +90,84 @@ class Nokia_PM:
         data[class_file][-1].append((attribute, text))
 
     def read_xml(self, xml_filename, write_directory):
-        if xml_filename.split('.')[-1] == 'gz':
-            xml_filename = gzip.open(xml_filename)
+        if self.offset_index and self.measurements is not None:
+            xml_filename = open_selected(xml_filename, lambda keys: keys.get('measurementType') in self.measurements,
+                                         'PMMOResult', ('PMSetup',), ('measurementType',),
+                                         get_index_directory(self.offset_index, write_directory))
+        xml_filename = open_input(xml_filename, self.metrics)
         logger.info(f'Working on {xml_filename}...')
-        tree = ET.parse(xml_filename)
-        context = tree.getroot()
+        context = etree.iterparse(xml_filename, events=('start', 'end'), tag=('PMSetup', 'PMMOResult'))
         logger.info(f'start context')
-        startTime = context.find('.//PMSetup').get('startTime')
-        interval = context.find('.//PMSetup').get('interval')
-        results_data = []
-        for elem in context.findall(".//PMMOResult"):
+        startTime = None
+        interval = None
+        for event, elem in context:
+            if elem.tag == 'PMSetup':
+                if event == 'start':
+                    startTime = elem.get('startTime')
+                    interval = elem.get('interval')
+                else:
+                    # its PMMOResults are freed already, the emptied elements and earlier PMSetups are left
+                    free_element(elem)
+                continue
+            if event == 'start':
+                continue
+            target = elem.find(".//PMTarget")
+            measurement_type = target.get("measurementType")
+            if self.measurements is not None and measurement_type not in self.measurements:
+                free_element(elem)
+                continue
+            counters = [c for c in target if self.counters is None or c.tag in self.counters]
+            if not counters:
+                free_element(elem)
+                continue
             data = {}
             mo = elem.findall(".//MO/DN")
-            measurement_type = elem.find(".//PMTarget").get("measurementType")
             data["MO_DN"] = ', '.join([i.text for i in mo])
             data["MeasurementType"] = measurement_type
             data['startTime'] = startTime
             data['interval'] = interval
 
-            for pm_target in elem.findall(".//PMTarget/*"):
+            for pm_target in counters:
                 data[pm_target.tag] = pm_target.text.strip()
 
-            results_data.append(data)
-        return results_data
-
-    def initialize_output(self, report_filename, fieldnames):
-        if not os.path.isfile(report_filename):
-            with open(report_filename, "w", newline="") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-
-    def add_data_to_csv(self, report_filename, data, fieldnames):
-        key_to_ignore = 'MeasurementType'
-        with open(report_filename, "a", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            if key_to_ignore in data:
-                # Создаем новый словарь, исключая ключ, который нужно игнорировать
-                filtered_data = {k: v for k, v in data.items() if k != key_to_ignore}
-            else:
-                filtered_data = data
-
-            writer.writerow(filtered_data)
-
-    def check_file(self, file_name, directory):
-        filepath = os.path.join(directory, file_name + '.csv')
-        if os.path.isfile(filepath):
-            return True
-        else:
-            return False
+            free_element(elem)
+            yield data
 
     def run(self, path_to_file, write_directory):
+        self.metrics = metrics = Metrics(source_name(path_to_file), pipelined=self.pipeline)
         result = self.read_xml(path_to_file, write_directory)
-        for n,data in enumerate(result,1):
-            write_result = f"{write_directory}/{data['MeasurementType']}.csv"
-            fieldnames = sorted([key for key in data.keys()], reverse=True)
-            fieldnames.remove('MeasurementType')
-            if not self.check_file(f"{data['MeasurementType']}.csv", write_directory):
-                self.initialize_output(write_result, fieldnames=fieldnames)
-            self.add_data_to_csv(write_result, data, fieldnames=fieldnames)
-            logger.info(f"Added row {n} records to csv")
+        layouts = get_registry(write_directory)
+        rollup = make_rollup(write_directory, self.rollup)
+        registry = open_mo_run(write_directory, self.output_format) if self.mo_ids else None
+        mo_key = 'MO_ID' if self.mo_ids else 'MO_DN'
+        new = None
+        with make_sink(write_directory, self.output_format, metrics) as sink:
+            for data in result:
+                with metrics.stage('transform'):
+                    # MeasurementType only names the target file
+                    measurement_type = data.pop('MeasurementType')
+                    mo_dn = data['MO_DN']
+                    if registry is not None:
+                        ids, new = registry.get_ids([data.pop('MO_DN')])
+                        data['MO_ID'] = ids[0]
+                    fieldnames = layouts.get_columns('nokia_pm_ids' if self.mo_ids else 'nokia_pm', measurement_type,
+                                                     data, lambda: sorted([key for key in data.keys()], reverse=True))
+                write_dimension(sink, new, parse_dn)
+                sink.write(measurement_type, fieldnames, [data], keys=(mo_key,), times=('startTime',))
+                if rollup is not None:
+                    with metrics.stage('rollup'):
+                        rollup.add_row(measurement_type, mo_dn, parse_time(data['startTime']),
+                                       {k: v for k, v in data.items() if k not in self.header_columns})
+            if rollup is not None:
+                with metrics.stage('rollup'):
+                    rollup.close()
+        if registry is not None:
+            # the MO rows of the run are on disk
+            registry.commit()
+        layouts.save()
+        self.outputs = sink.outputs
+        metrics.finish()
+        return sink.rows_written
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from bench.generate import formats, generate, parse_size
+from common.metrics import peak_rss_mb
+
+# parser class and the generator reading the XML into records, timed alone as the read stage
+parsers = {
+    'ericsson-pm': ('Erikson.pm.parse_pm', 'Ericsson_PM', 'parse_data'),
+    'huawei-pm': ('Huawei.pm.parse_pm', 'Huawei_PM', 'read_xml'),
+    'nokia-pm': ('Nokia.pm.parse_pm', 'Nokia_PM', 'read_xml'),
+    'ericsson-cm': ('Erikson.cm.parse_cm', 'Ericsson_CM', 'read_xml'),
+    'nokia-cm': ('Nokia.cm.parse_cm', 'Nokia_CM', 'read_xml'),
+}
+
+
+def measure(output_format, stage, path, write_directory, output_options, results):
+    """
+    Run one stage of one parser in a fresh process, so peak RSS is that of the stage alone
+    """
+    module_name, class_name, read_method = parsers[output_format]
+    module = __import__(module_name, fromlist=[class_name])
+    parser = getattr(module, class_name)(**output_options)
+    started = time.perf_counter()
+    stages = {}
+    if stage == 'read':
+        # the reading generators yield one record per measInfo / measurement block / MO, not output rows
+        rows = sum(1 for _ in getattr(parser, read_method)(path, write_directory))
+    else:
+        rows = parser.run(path, write_directory) or 0
+        stages = parser.metrics.summary()['stages']
+    results.put({'seconds': time.perf_counter() - started, 'rows': rows, 'peak_rss_mb': peak_rss_mb(),
+                 'stages': stages})
+
+
+def run_case(output_format, stage, path, repeat, output_options):
+    context = multiprocessing.get_context('spawn')
+    best = None
+    for _ in range(repeat):
+        write_directory = tempfile.mkdtemp(prefix='bench-out-')
+        results = context.Queue()
+        process = context.Process(target=measure,
+                                  args=(output_format, stage, path, write_directory, output_options, results))
+        process.start()
+        result = results.get()
+        process.join()
+        shutil.rmtree(write_directory, ignore_errors=True)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    size_mb = os.path.getsize(path) / 1024 ** 2
+    best['mb'] = size_mb
+    best['mb_per_sec'] = size_mb / best['seconds'] if best['seconds'] else 0.0
+    best['rows_per_sec'] = best['rows'] / best['seconds'] if best['seconds'] else 0.0
+    return best
+
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions against a saved baseline: throughput lower or peak RSS higher than the tolerance allows
+    """
+    regressions = []
+    for case, result in results.items():
+        previous = baseline.get('results', {}).get(case)
+        if previous is None:
+            continue
+        if result['mb_per_sec'] < previous['mb_per_sec'] * (1 - tolerance):
+            regressions.append(f"{case}: {result['mb_per_sec']:.2f} MB/s, baseline {previous['mb_per_sec']:.2f} MB/s")
+        if result['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{case}: peak RSS {result['peak_rss_mb']:.0f} MB, "
+                               f"baseline {previous['peak_rss_mb']:.0f} MB")
+        if result['rows'] != previous['rows']:
+            regressions.append(f"{case}: {result['rows']} rows, baseline {previous['rows']} rows")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vendor parsers on synthetic exports")
+    parser.add_argument("--formats", nargs="+", default=list(formats), choices=formats, help="Formats to benchmark")
+    parser.add_argument("--size", default="10MB", help="Size of the generated exports, e.g. 1MB, 200MB, 2GB")
+    parser.add_argument("--data-directory", default=os.path.join(tempfile.gettempdir(), 'parser-bench'),
+                        help="Where the generated exports are kept and reused between runs")
+    parser.add_argument("--gzip", action="store_true", help="Benchmark gzipped exports")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case, the fastest is kept")
+    parser.add_argument("--output-format", default="csv", help="Output format of the parsers")
+    parser.add_argument("--pipeline", action="store_true", help="Run the parsers with pipelined read/parse/write")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--save-baseline", help="Save the results as the baseline to this file")
+    parser.add_argument("--baseline", help="Compare the results with this baseline and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed relative drop of MB/s or growth of peak RSS against the baseline")
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    os.makedirs(args.data_directory, exist_ok=True)
+    results = {}
+    for output_format in args.formats:
+        path = os.path.join(args.data_directory, f"{output_format}-{args.size}.xml{'.gz' if args.gzip else ''}")
+        if not os.path.isfile(path):
+            print(f"Generating {path}...")
+            generate(output_format, path, size)
+        for stage in ('read', 'total'):
+            output_options = {'output_format': args.output_format}
+            if args.pipeline:
+                output_options['pipeline'] = True
+            result = run_case(output_format, stage, path, args.repeat, output_options)
+            case = f'{output_format}/{stage}'
+            results[case] = result
+            print(f"{case:20} {result['seconds']:8.2f}s {result['rows']:>10} rows {result['rows_per_sec']:>10.0f} rows/s "
+                  f"{result['mb_per_sec']:7.2f} MB/s {result['peak_rss_mb']:7.0f} MB peak RSS")
+            if result['stages']:
+                print(' ' * 21 + ' '.join(f"{name} {seconds:.2f}s" for name, seconds in result['stages'].items()))
+
+    report = {
+        'size': args.size,
+        'gzip': args.gzip,
+        'pipeline': args.pipeline,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+import argparse
+import gzip
+import random
+import re
+from abc import ABC, abstractmethod
+
+# a pool of counter values, picked at random instead of formatting a new number for every value
+value_pool = [str(v) for v in range(0, 1000, 3)] + [str(v) for v in range(1000, 1000000, 9973)] + ['0'] * 50
+
+size_units = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+
+def parse_size(size):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*', size.upper())
+    if match is None:
+        raise ValueError(f'Invalid size: {size}')
+    return int(float(match.group(1)) * size_units[match.group(2)])
+
+
+class Generator(ABC):
+    """
+    Synthetic export of one format: a header, blocks repeated until the requested size and a footer.
+    Each block is one measInfo / measurement or one group of managed objects with `objects` objects of
+    `counters` counters (parameters for CM); for the formats that have them, `pdf` counters per object are
+    PDF arrays (lists for Nokia CM) of `pdf_length` values
+    """
+    begin_time = '2023-06-20T23:00:00+00:00'
+    end_time = '2023-06-21T00:00:00+00:00'
+
+    def __init__(self, objects=50, counters=40, pdf=2, pdf_length=10, measurements=20, nil_ratio=0.01, seed=0):
+        self.objects = objects
+        self.counters = counters
+        self.pdf = min(pdf, counters)
+        self.pdf_length = pdf_length
+        self.measurements = measurements
+        self.nil_ratio = nil_ratio
+        self.random = random.Random(seed)
+
+    def values(self, count):
+        return self.random.choices(value_pool, k=count)
+
+    def pdf_value(self):
+        return ','.join(self.values(self.pdf_length))
+
+    @abstractmethod
+    def header(self):
+        """
+        Text before the first block: the XML declaration, root element and file header
+        """
+
+    @abstractmethod
+    def block(self, n):
+        """
+        Text of the n-th block, each one with ids of its own
+        """
+
+    @abstractmethod
+    def footer(self):
+        """
+        Text after the last block, closing the elements opened by the header
+        """
+
+
+class EricssonPM(Generator):
+    namespace = 'http://www.3gpp.org/ftp/specs/archive/32_series/32.435#measCollec'
+
+    def header(self):
+        return (f'<?xml version="1.0" encoding="UTF-8"?>\n<measCollecFile xmlns="{self.namespace}">\n'
+                f'<fileHeader fileFormatVersion="32.435 V10.0" vendorName="Ericsson AB">'
+                f'<fileSender elementType="RadioNode"/><measCollec beginTime="{self.begin_time}"/></fileHeader>\n'
+                f'<measData><managedElement localDn="ManagedElement=BENCH1"/>\n')
+
+    def block(self, n):
+        group = n % self.measurements
+        lines = [f'<measInfo measInfoId="PM=1,PmGroup=Group{group}">\n<job jobId="USERDEF"/>'
+                 f'<granPeriod duration="PT900S" endTime="{self.end_time}"/><repPeriod duration="PT900S"/>\n']
+        lines.append(''.join(f'<measType p="{p}">pmGroup{group}Counter{p}</measType>'
+                             for p in range(1, self.counters + 1)) + '\n')
+        for obj in range(self.objects):
+            values = self.values(self.counters)
+            for p in range(self.pdf):
+                values[p] = self.pdf_value()
+            lines.append(f'<measValue measObjLdn="ManagedElement=BENCH1,ENodeBFunction=1,Group{group}={n}_{obj}">'
+                         + ''.join(f'<r p="{p}">{v}</r>' for p, v in enumerate(values, 1)) + '</measValue>\n')
+        lines.append('</measInfo>\n')
+        return ''.join(lines)
+
+    def footer(self):
+        return f'</measData>\n<fileFooter><measCollec endTime="{self.end_time}"/></fileFooter>\n</measCollecFile>\n'
+
+
+class HuaweiPM(Generator):
+    namespace = 'http://latest/nmc-omc/cmNrm.doc#measCollec'
+
+    def header(self):
+        return (f'<?xml version="1.0" encoding="UTF-8"?>\n<measCollecFile xmlns="{self.namespace}">\n'
+                f'<fileHeader fileFormatVersion="32.435 V7.2" vendorName="Huawei">'
+                f'<fileSender elementType="BTS3900"/><measCollec beginTime="{self.begin_time}"/></fileHeader>\n'
+                f'<measData>\n<managedElement userLabel="BENCH1"/>\n')
+
+    def block(self, n):
+        group = n % self.measurements
+        counters = ' '.join(str(1526700000 + group * 1000 + c) for c in range(self.counters))
+        lines = [f'<measInfo measInfoId="{50331000 + group}">\n<granPeriod duration="PT3600S" endTime="{self.end_time}"/>\n'
+                 f'<repPeriod duration="PT3600S"/>\n<measTypes>{counters}</measTypes>\n']
+        for obj in range(self.objects):
+            values = self.values(self.counters)
+            if self.random.random() < self.nil_ratio:
+                values[self.random.randrange(self.counters)] = 'NIL'
+            lines.append(f'<measValue measObjLdn="BENCH1/Group{group}:Label={n}, Local Cell ID={obj}">'
+                         f'<measResults>{" ".join(values)}</measResults></measValue>\n')
+        lines.append('</measInfo>\n')
+        return ''.join(lines)
+
+    def footer(self):
+        return f'</measData>\n<fileFooter><measCollec endTime="{self.end_time}"/></fileFooter>\n</measCollecFile>\n'
+
+
+class NokiaPM(Generator):
+
+    def header(self):
+        return '<?xml version="1.0"?>\n<OMeS>\n'
+
+    def block(self, n):
+        group = n % self.measurements
+        lines = [f'<PMSetup startTime="2023-06-21T00:30:00.000-03:00:00" interval="15">\n']
+        for obj in range(self.objects):
+            values = self.values(self.counters)
+            lines.append(f'<PMMOResult><MO><DN><![CDATA[PLMN-PLMN/MRBTS-{n}/LNBTS-{n}/LNCEL-{obj}]]></DN></MO>'
+                         f'<PMTarget measurementType="LTE_Group{group}">'
+                         + ''.join(f'<M{8000 + group}C{c}>{v}</M{8000 + group}C{c}>' for c, v in enumerate(values))
+                         + '</PMTarget></PMMOResult>\n')
+        lines.append('</PMSetup>\n')
+        return ''.join(lines)
+
+    def footer(self):
+        return '</OMeS>\n'
+
+
+class EricssonCM(Generator):
+
+    def header(self):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<bulkCmConfigDataFile xmlns="configData.xsd" '
+                'xmlns:xn="genericNrm.xsd" xmlns:es="EricssonSpecificAttributes.xsd">\n'
+                '<fileHeader fileFormatVersion="32.615 V4.5" vendorName="Ericsson"/>\n'
+                '<configData dnPrefix="Undefined">\n<xn:SubNetwork id="BENCH">\n')
+
+    def block(self, n):
+        group = n % self.measurements
+        lines = [f'<xn:MeContext id="NODE{n}">\n<xn:ManagedElement id="1">\n']
+        for obj in range(self.objects):
+            values = self.values(self.counters)
+            for p in range(self.pdf):
+                values[p] = self.pdf_value()
+            lines.append(f'<xn:VsDataContainer id="{obj}">\n<xn:attributes>\n'
+                         f'<xn:vsDataType>vsDataGroup{group}</xn:vsDataType>\n'
+                         f'<xn:vsDataFormatVersion>EricssonSpecificAttributes.17.28</xn:vsDataFormatVersion>\n'
+                         f'<es:vsDataGroup{group}>\n'
+                         + ''.join(f'<es:param{c}>{v}</es:param{c}>\n' for c, v in enumerate(values))
+                         + f'</es:vsDataGroup{group}>\n</xn:attributes>\n</xn:VsDataContainer>\n')
+        lines.append('</xn:ManagedElement>\n</xn:MeContext>\n')
+        return ''.join(lines)
+
+    def footer(self):
+        return ('</xn:SubNetwork>\n</configData>\n<fileFooter dateTime="2023-03-06T04:34:45"/>\n'
+                '</bulkCmConfigDataFile>\n')
+
+
+class NokiaCM(Generator):
+
+    def header(self):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<raml version="2.0" xmlns="raml20.xsd">\n'
+                '<cmData type="actual" scope="all" name="dump">\n<header><log dateTime="2023-06-21T00:00:00" '
+                'action="created" appInfo="ActualExporter">InternalValues are used</log></header>\n')
+
+    def block(self, n):
+        group = n % self.measurements
+        lines = []
+        for obj in range(self.objects):
+            values = self.values(self.counters)
+            lines.append(f'<managedObject class="CLASS{group}" version="SBTS23R1" '
+                         f'distName="PLMN-PLMN/MRBTS-{n}/CLASS{group}-{obj}" id="{n * self.objects + obj}">\n'
+                         + ''.join(f'  <p name="param{c}">{v}</p>\n' for c, v in enumerate(values[self.pdf:]))
+                         + ''.join(f'  <list name="list{p}">' + ''.join(f'<p>{v}</p>' for v in self.values(self.pdf_length))
+                                   + '</list>\n' for p in range(self.pdf))
+                         + '</managedObject>\n')
+        return ''.join(lines)
+
+    def footer(self):
+        return '</cmData>\n</raml>\n'
+
+
+formats = {
+    'ericsson-pm': EricssonPM,
+    'huawei-pm': HuaweiPM,
+    'nokia-pm': NokiaPM,
+    'ericsson-cm': EricssonCM,
+    'nokia-cm': NokiaCM,
+}
+
+
+def generate(output_format, path, size, **options):
+    """
+    Write a synthetic export of about size bytes (uncompressed) to path, gzipped when path ends with .gz.
+    Returns the number of uncompressed bytes written
+    """
+    generator = formats[output_format](**options)
+    header = generator.header()
+    footer = generator.footer()
+    with gzip.open(path, 'wt', encoding='utf-8') if path.endswith('.gz') else open(path, 'w') as f:
+        f.write(header)
+        written = len(header)
+        n = 0
+        while written + len(footer) < size or n == 0:
+            text = generator.block(n)
+            f.write(text)
+            written += len(text)
+            n += 1
+        f.write(footer)
+        written += len(footer)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic vendor exports for benchmarks")
+    parser.add_argument("--format", required=True, choices=formats, help="Export format to generate")
+    parser.add_argument("--size", default="10MB", help="Approximate uncompressed size, e.g. 1MB, 500MB, 4GB")
+    parser.add_argument("--output", required=True, help="File to write, gzipped when it ends with .gz")
+    parser.add_argument("--objects", type=int, default=50, help="Objects per measInfo/measurement block")
+    parser.add_argument("--counters", type=int, default=40, help="Counters (CM: parameters) per object")
+    parser.add_argument("--pdf", type=int, default=2, help="PDF array counters (CM: list parameters) per object")
+    parser.add_argument("--pdf-length", type=int, default=10, help="Values per PDF array")
+    parser.add_argument("--measurements", type=int, default=20,
+                        help="Distinct measInfo/measurement types (CM: classes)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    written = generate(args.format, args.output, parse_size(args.size), objects=args.objects,
+                       counters=args.counters, pdf=args.pdf, pdf_length=args.pdf_length,
+                       measurements=args.measurements, seed=args.seed)
+    print(f"Wrote {written / 1024 ** 2:.1f} MB of {args.format} to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
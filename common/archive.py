@@ -0,0 +1,147 @@
+import gzip
+import logging
+import os
+import queue
+import tarfile
+import threading
+import zipfile
+from common.metrics import Metrics
+from common.stream import archive_extensions, is_input_name, xml_extensions
+
+logger = logging.getLogger(__name__)
+
+# queue markers of the reader thread
+_end_of_member = object()
+_end_of_archive = object()
+
+
+def is_archive(path):
+    return isinstance(path, str) and path.lower().endswith(archive_extensions)
+
+
+def open_members(path):
+    """
+    Yield (name, binary stream) for every XML member of a zip or tar archive, in archive order.
+    Tar archives are read as a stream, so members are never extracted nor seeked; gzipped members
+    are decompressed on the fly
+    """
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_input_name(info.filename, xml_extensions) and not is_archive(info.filename):
+                    with archive.open(info) as member:
+                        yield info.filename, member
+        return
+    with tarfile.open(path, 'r|*') as archive:
+        for info in archive:
+            if info.isfile() and is_input_name(info.name, xml_extensions) and not is_archive(info.name):
+                yield info.name, archive.extractfile(info)
+
+
+class MemberStream:
+    """
+    Read-only binary stream over the chunks of one archive member, as queued by the reader thread
+    """
+
+    def __init__(self, name, chunks):
+        self.name = name
+        self._chunks = chunks
+        self._buffer = bytearray()
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self._chunks.get()
+            if chunk is _end_of_member:
+                self._eof = True
+            elif isinstance(chunk, BaseException):
+                raise chunk
+            else:
+                self._buffer += chunk
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def drain(self):
+        # skip what the parser did not read, the next member follows in the same queue
+        while not self._eof:
+            self._buffer.clear()
+            self.read(1 << 20)
+        self._buffer.clear()
+
+
+def iter_members(path, prefetch=16, chunk_size=1 << 20):
+    """
+    Yield a MemberStream per XML member of the archive. A background thread decompresses up to prefetch
+    chunks ahead, so decompression overlaps with the parsing of the member being read
+    """
+    chunks = queue.Queue(prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_archive():
+        try:
+            for name, member in open_members(path):
+                if name.lower().endswith('.gz'):
+                    member = gzip.GzipFile(fileobj=member)
+                if not put(os.path.basename(name)):
+                    return
+                while chunk := member.read(chunk_size):
+                    if not put(chunk):
+                        return
+                if not put(_end_of_member):
+                    return
+        except Exception as ex:
+            put(ex)
+        put(_end_of_archive)
+
+    reader = threading.Thread(target=read_archive, name=f'archive-reader-{os.path.basename(path)}', daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is _end_of_archive:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            member = MemberStream(item, chunks)
+            yield member
+            member.drain()
+    finally:
+        stop.set()
+        reader.join()
+
+
+def run_parser(parser, path, write_directory):
+    """
+    Run a parser on a file or, for an archive, on each of its XML members in turn.
+    The parser outputs and metrics are those of all members
+    """
+    if not is_archive(path):
+        return parser.run(path, write_directory)
+    if getattr(parser, 'delta', None) is not None:
+        # each member would be compared with the snapshot of the previous member, and its MOs reported removed
+        raise ValueError(f'{path}: a delta is taken of a single dump, not of the members of an archive')
+    rows = 0
+    members = 0
+    outputs = {}
+    metrics = Metrics(os.path.basename(path))
+    for member in iter_members(path):
+        rows += parser.run(member, write_directory) or 0
+        members += 1
+        outputs.update(dict.fromkeys(parser.outputs))
+        metrics.merge(parser.metrics)
+    logger.info(f'{path}: {members} members, {rows} rows')
+    parser.outputs = list(outputs)
+    parser.metrics = metrics.finish()
+    return rows
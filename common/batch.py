@@ -0,0 +1,111 @@
+import glob
+import logging
+import os
+import time
+from multiprocessing import Pool
+from common.archive import run_parser
+from common.manifest import parser_signature
+from common.metrics import aggregate
+from common.stream import is_input_name
+
+logger = logging.getLogger(__name__)
+
+# parser instances owned by the current pool worker, created once per parser signature
+_parsers = {}
+
+
+def read_file_list(list_filename):
+    with open(list_filename) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def collect_files(paths):
+    """
+    Expand directories, glob patterns and @list files into a sorted list of input files and archives
+    """
+    files = []
+    for path in paths:
+        if path.startswith('@'):
+            files.extend(collect_files(read_file_list(path[1:])))
+        elif os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if is_input_name(name))
+        elif glob.has_magic(path):
+            files.extend(p for p in glob.glob(path, recursive=True) if os.path.isfile(p))
+        else:
+            files.append(path)
+    return sorted(set(files))
+
+
+def check_output_format(parser_kwargs, workers):
+    """
+    Plain CSV files are appended to by every process parsing a file of their table, each writing its own
+    header and rewriting the file when columns are added: several workers must write csv-shards instead
+    """
+    if workers > 1 and (parser_kwargs or {}).get('output_format', 'csv') == 'csv':
+        raise ValueError(f'csv output cannot be written by {workers} workers at once, use csv-shards '
+                         f'(merged by --compact) or another output format')
+
+
+def get_parser(parser_class, parser_kwargs):
+    signature = parser_signature(parser_class, parser_kwargs)
+    parser = _parsers.get(signature)
+    if parser is None:
+        parser = _parsers[signature] = parser_class(**parser_kwargs)
+    return parser
+
+
+def parse_file(task):
+    """
+    Pool task: (parser_class, parser_kwargs, path, write_directory)
+    -> (path, rows, elapsed, error, outputs, metrics summary)
+    """
+    parser_class, parser_kwargs, path, write_directory = task
+    started = time.perf_counter()
+    try:
+        parser = get_parser(parser_class, parser_kwargs)
+        rows = run_parser(parser, path, write_directory) or 0
+    except Exception as ex:
+        logger.exception(f'Failed to parse {path}')
+        return path, 0, time.perf_counter() - started, repr(ex), [], None
+    metrics = parser.metrics.summary()
+    metrics['file'] = path
+    return path, rows, time.perf_counter() - started, None, parser.outputs, metrics
+
+
+def run_batch(parser_class, files, write_directory, workers=None, parser_kwargs=None, manifest=None, force=False):
+    """
+    Parse files across a pool of worker processes, each worker reusing a single parser instance.
+    With a manifest, files already parsed unchanged by the same parser are skipped (unless force)
+    and every parsed file is recorded as soon as it is done, so an interrupted batch resumes.
+    Returns an aggregate summary with throughput in files/s and rows/s, and the stage metrics per file and
+    for the whole batch
+    """
+    workers = workers or os.cpu_count()
+    check_output_format(parser_kwargs, workers)
+    signature = parser_signature(parser_class, parser_kwargs)
+    skipped = 0
+    if manifest is not None and not force:
+        pending = [path for path in files if not manifest.is_done(path, signature)]
+        skipped = len(files) - len(pending)
+        files = pending
+    tasks = [(parser_class, parser_kwargs or {}, path, write_directory) for path in files]
+    summary = {'files': len(files), 'skipped': skipped, 'failed': [], 'rows': 0, 'workers': workers}
+    file_metrics = []
+    started = time.perf_counter()
+    with Pool(workers) as pool:
+        for n, (path, rows, elapsed, error, outputs, metrics) in enumerate(pool.imap_unordered(parse_file, tasks), 1):
+            if error is not None:
+                summary['failed'].append((path, error))
+                continue
+            file_metrics.append(metrics)
+            if manifest is not None:
+                manifest.record(path, signature, outputs, rows)
+            summary['rows'] += rows
+            logger.info(f'[{n}/{len(tasks)}] {path}: {rows} rows in {elapsed:.2f}s')
+    seconds = time.perf_counter() - started
+    summary['seconds'] = seconds
+    summary['files_per_sec'] = len(files) / seconds if seconds else 0.0
+    summary['rows_per_sec'] = summary['rows'] / seconds if seconds else 0.0
+    summary['metrics'] = {'files': file_metrics, 'batch': aggregate(file_metrics, seconds)}
+    return summary
@@ -0,0 +1,19 @@
+import json
+import socket
+
+
+def send_job(socket_path, job, timeout=None):
+    """
+    Send one parse job to the server listening on socket_path and wait for its result. Only the standard
+    library is imported here, so a client process starts in a fraction of the time a parser needs
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+        with connection.makefile('rwb') as f:
+            f.write(json.dumps(job).encode() + b'\n')
+            f.flush()
+            line = f.readline()
+    if not line:
+        raise ConnectionError(f'{socket_path}: the server closed the connection without a result')
+    return json.loads(line)
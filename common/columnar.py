@@ -0,0 +1,139 @@
+import logging
+import os
+import uuid
+from contextlib import nullcontext
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnarSink:
+    """
+    Parquet/Feather output with the same interface as CsvSink: rows are collected per table and written
+    as typed row groups of at most row_group_rows rows into part files under {write_directory}/{table}/
+    """
+    extensions = {'parquet': '.parquet', 'feather': '.feather'}
+
+    def __init__(self, write_directory, output_format='parquet', row_group_rows=100000, metrics=None):
+        if output_format not in self.extensions:
+            raise ValueError(f'Unknown columnar format: {output_format}')
+        self.write_directory = write_directory
+        self.output_format = output_format
+        self.row_group_rows = row_group_rows
+        self.metrics = metrics
+        self.rows_written = 0
+        self._rows = {}
+        self._frames = {}
+        self._columns = {}
+        self._writers = {}
+        self._pending_total = 0
+        self.outputs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def timed(self):
+        return nullcontext() if self.metrics is None else self.metrics.stage('write')
+
+    def write(self, table, fieldnames, rows, keys=(), times=(), measurement=None):
+        with self.timed():
+            columns = self._columns.setdefault(table, {})
+            for name in fieldnames:
+                columns.setdefault(name, None)
+            buffered = self._rows.setdefault(table, [])
+            count = len(buffered)
+            buffered.extend(rows)
+            count = len(buffered) - count
+            self.added(table, count)
+
+    def write_columns(self, table, fieldnames, columns, keys=(), times=(), measurement=None):
+        """
+        Write a column-oriented block: columns maps a column name to a list or ndarray of equal length,
+        numeric arrays keep their dtype
+        """
+        with self.timed():
+            table_columns = self._columns.setdefault(table, {})
+            for name in fieldnames:
+                table_columns.setdefault(name, None)
+            frame = pd.DataFrame(columns)
+            self._frames.setdefault(table, []).append(frame)
+            self._rows.setdefault(table, [])
+            self.added(table, len(frame))
+
+    def added(self, table, count):
+        self._pending_total += count
+        self.rows_written += count
+        if self.metrics is not None:
+            self.metrics.add_rows(count)
+        pending = len(self._rows[table]) + sum(len(frame) for frame in self._frames.get(table, ()))
+        if pending >= self.row_group_rows:
+            self.write_row_group(table)
+        elif self._pending_total >= self.row_group_rows * 10:
+            self.flush()
+
+    def get_frame(self, table):
+        columns = list(self._columns[table])
+        frames = self._frames.pop(table, [])
+        if self._rows[table]:
+            frames.append(pd.DataFrame.from_records(self._rows[table], columns=columns))
+        frame = pd.concat(frames, ignore_index=True).reindex(columns=columns)
+        for column in frame.columns:
+            # the text columns are object columns, or str columns from pandas 3 on
+            if not (pd.api.types.is_object_dtype(frame[column]) or pd.api.types.is_string_dtype(frame[column])):
+                continue
+            try:
+                frame[column] = pd.to_numeric(frame[column])
+            except (ValueError, TypeError):
+                frame[column] = frame[column].astype('string')
+        return frame
+
+    def open_writer(self, table, schema):
+        directory = os.path.join(self.write_directory, table)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'part-{uuid.uuid4().hex}{self.extensions[self.output_format]}')
+        self.outputs.append(path)
+        if self.output_format == 'parquet':
+            return pq.ParquetWriter(path, schema)
+        return pa.ipc.new_file(path, schema)
+
+    def write_row_group(self, table):
+        if not self._rows[table] and not self._frames.get(table):
+            return
+        frame = self.get_frame(table)
+        data = pa.Table.from_pandas(frame, preserve_index=False)
+        writer, schema = self._writers.get(table, (None, None))
+        if writer is not None and data.schema != schema:
+            try:
+                data = data.cast(schema)
+            except (ValueError, pa.ArrowException):
+                # new columns or incompatible types: continue the table in a new part file
+                writer.close()
+                writer = None
+        if writer is None:
+            writer = self.open_writer(table, data.schema)
+            self._writers[table] = (writer, data.schema)
+        if self.output_format == 'parquet':
+            writer.write_table(data, row_group_size=self.row_group_rows)
+        else:
+            writer.write_table(data, max_chunksize=self.row_group_rows)
+        self._pending_total -= len(frame)
+        self._rows[table] = []
+
+    def flush(self):
+        for table in self._rows:
+            self.write_row_group(table)
+
+    def close(self):
+        with self.timed():
+            self.flush()
+            for writer, _ in self._writers.values():
+                writer.close()
+            self._writers.clear()
+        logger.info(f'Wrote {self.rows_written} rows to {len(self._columns)} tables in {self.write_directory}')
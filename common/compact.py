@@ -0,0 +1,132 @@
+import csv
+import fcntl
+import glob
+import heapq
+import json
+import logging
+import os
+from common.sink import sort_columns_filename
+
+logger = logging.getLogger(__name__)
+
+# parts being merged and the merged file not yet moved in place, written at the commit point of a compaction
+journal_filename = 'compact.json'
+
+
+def read_sort_columns(directory):
+    try:
+        with open(os.path.join(directory, sort_columns_filename)) as f:
+            columns = json.load(f)
+    except FileNotFoundError:
+        return []
+    return list(dict.fromkeys(columns['times'] + columns['keys']))
+
+
+def get_sort_key(header, sort_columns):
+    # rows are ordered by their time and key columns, or by all their columns when the table has none
+    positions = [header.index(c) for c in sort_columns if c in header]
+    if not positions:
+        return None
+    return lambda row: tuple(row[i] for i in positions)
+
+
+def read_rows(path, header):
+    """
+    Rows of a CSV file in the column order of header, which has every column of the file
+    """
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader, [])
+        if columns == header[:len(columns)]:
+            padding = [''] * (len(header) - len(columns))
+            for row in reader:
+                yield row + padding
+            return
+        positions = [columns.index(c) if c in columns else -1 for c in header]
+        for row in reader:
+            yield [row[i] if 0 <= i < len(row) else '' for i in positions]
+
+
+def read_header(path):
+    with open(path, newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def finish(directory, target):
+    """
+    Complete a compaction interrupted after its commit point: move the merged file in place if it is still
+    there and remove the parts it holds. A merged file without journal was left before the commit point
+    """
+    journal_path = os.path.join(directory, journal_filename)
+    if not os.path.isfile(journal_path):
+        for path in glob.glob(os.path.join(directory, '*.compact.tmp')):
+            os.remove(path)
+        return
+    with open(journal_path) as f:
+        journal = json.load(f)
+    tmp_path = os.path.join(directory, journal['merged'])
+    if os.path.isfile(tmp_path):
+        os.replace(tmp_path, target)
+    for name in journal['parts']:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            os.remove(path)
+    os.remove(journal_path)
+
+
+def compact_table(write_directory, table):
+    """
+    Merge the finished part files of a table, and the rows of earlier compactions, into {table}.csv sorted by
+    the table's time and key columns. The header is the union of the headers, columns missing from a file are
+    left empty. The compacted file is sorted already, so only the new parts are sorted in memory and merged
+    with it as a stream. Returns (parts, rows) of the merged parts
+    """
+    directory = os.path.join(write_directory, table)
+    target = os.path.join(write_directory, f'{table}.csv')
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        # compactions of the same table wait for each other, the writers never take the lock
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        finish(directory, target)
+        parts = sorted(glob.glob(os.path.join(directory, 'part-*.csv')))
+        if not parts:
+            return 0, 0
+        inputs = ([target] if os.path.isfile(target) else []) + parts
+        header = list(dict.fromkeys(column for path in inputs for column in read_header(path)))
+        sort_key = get_sort_key(header, read_sort_columns(directory))
+        rows = [row for path in parts for row in read_rows(path, header)]
+        rows.sort(key=sort_key)
+        merged = 'merged.compact.tmp'
+        tmp_path = os.path.join(directory, merged)
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            if os.path.isfile(target):
+                writer.writerows(heapq.merge(read_rows(target, header), rows, key=sort_key))
+            else:
+                writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        journal_path = os.path.join(directory, journal_filename)
+        with open(f'{journal_path}.tmp', 'w') as f:
+            json.dump({'merged': merged, 'parts': [os.path.basename(path) for path in parts]}, f)
+        os.replace(f'{journal_path}.tmp', journal_path)
+        finish(directory, target)
+    logger.info(f'Compacted {len(parts)} part files of {table} into {target}: {len(rows)} new rows')
+    return len(parts), len(rows)
+
+
+def compact(write_directory, tables=None):
+    """
+    Compact the sharded tables of write_directory (csv-shards output), or the given ones.
+    Returns {table: (parts, rows)} of the tables having new parts
+    """
+    if not tables:
+        tables = sorted(entry.name for entry in os.scandir(write_directory) if entry.is_dir()
+                        and (glob.glob(os.path.join(entry.path, 'part-*.csv'))
+                             or os.path.isfile(os.path.join(entry.path, journal_filename))))
+    summary = {}
+    for table in tables:
+        parts, rows = compact_table(write_directory, table)
+        if parts:
+            summary[table] = (parts, rows)
+    return summary
@@ -0,0 +1,123 @@
+import json
+import logging
+import sqlite3
+import zlib
+from array import array
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotIndex:
+    """
+    On-disk index of the previous CM snapshot of a network: the class of every MO DN and a 4-byte hash of
+    each of its parameters, packed in the order the class' parameter names were first seen. A new dump is
+    compared with it MO by MO: get_delta() returns None for an unchanged MO, the full row of an added one and
+    only the changed parameters of a modified one; removed() gives the MOs missing from the dump. The index
+    becomes the new snapshot on commit(), in the same transaction as the comparison, so an interrupted run
+    keeps the previous snapshot
+    """
+    flush_rows = 10000
+
+    def __init__(self, path, key, context=()):
+        self.path = path
+        self.key = key
+        self.context = context
+        self.connection = sqlite3.connect(path, timeout=300)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS mo (dn TEXT PRIMARY KEY, class TEXT, params BLOB, generation INTEGER)
+                WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS class_params (class TEXT PRIMARY KEY, names TEXT);
+            CREATE TABLE IF NOT EXISTS snapshot (generation INTEGER);
+        ''')
+        row = self.connection.execute('SELECT max(generation) FROM snapshot').fetchone()
+        self.generation = (row[0] or 0) + 1
+        self.counts = Counter()
+        self._positions = {}
+        self._new_names = set()
+        self._upserts = []
+        self._touched = []
+        self._last_context = {}
+
+    def get_positions(self, class_name, names):
+        positions = self._positions.get(class_name)
+        if positions is None:
+            row = self.connection.execute('SELECT names FROM class_params WHERE class = ?', (class_name,)).fetchone()
+            positions = self._positions[class_name] = {n: i for i, n in enumerate(json.loads(row[0]) if row else [])}
+        for name in names:
+            if name not in positions:
+                # new parameters are appended: the hashes of the MOs already indexed keep their positions
+                positions[name] = len(positions)
+                self._new_names.add(class_name)
+        return positions
+
+    def get_hashes(self, positions, params):
+        hashes = array('I', bytes(4 * len(positions)))
+        for name, value in params.items():
+            # 0 marks a missing parameter
+            hashes[positions[name]] = zlib.crc32(str(value if value is not None else '').encode()) or 1
+        while hashes and not hashes[-1]:
+            hashes.pop()
+        return hashes
+
+    def get_delta(self, class_name, row):
+        dn = row.get(self.key)
+        if not dn:
+            return row
+        context = {k: row[k] for k in self.context if k in row}
+        self._last_context = context
+        params = {k: v for k, v in row.items() if k != self.key and k not in context}
+        positions = self.get_positions(class_name, params)
+        hashes = self.get_hashes(positions, params)
+        blob = hashes.tobytes()
+        previous = self.connection.execute('SELECT class, params FROM mo WHERE dn = ?', (dn,)).fetchone()
+        if previous is not None and previous[0] == class_name and previous[1] == blob:
+            self._touched.append((self.generation, dn))
+            self.buffered()
+            self.counts['unchanged'] += 1
+            return None
+        self._upserts.append((dn, class_name, blob, self.generation))
+        self.buffered()
+        if previous is None or previous[0] != class_name:
+            self.counts['added'] += 1
+            return {**row, 'Change': 'added'}
+        old = array('I', previous[1])
+        changed = [name for name, i in positions.items()
+                   if (old[i] if i < len(old) else 0) != (hashes[i] if i < len(hashes) else 0)]
+        self.counts['modified'] += 1
+        delta = {**context, self.key: dn, 'Change': 'modified', 'ChangedParameters': ';'.join(changed)}
+        delta.update((name, params.get(name, '')) for name in changed)
+        return delta
+
+    def buffered(self):
+        if len(self._upserts) + len(self._touched) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self._upserts:
+            self.connection.executemany('INSERT OR REPLACE INTO mo VALUES (?, ?, ?, ?)', self._upserts)
+            self._upserts.clear()
+        if self._touched:
+            self.connection.executemany('UPDATE mo SET generation = ? WHERE dn = ?', self._touched)
+            self._touched.clear()
+
+    def removed(self):
+        """
+        (class, row) of every indexed MO not seen in the dump, which are dropped from the index
+        """
+        self.flush()
+        rows = self.connection.execute('SELECT class, dn FROM mo WHERE generation < ?', (self.generation,)).fetchall()
+        self.connection.execute('DELETE FROM mo WHERE generation < ?', (self.generation,))
+        self.counts['removed'] += len(rows)
+        return [(class_name, {**self._last_context, self.key: dn, 'Change': 'removed'}) for class_name, dn in rows]
+
+    def commit(self):
+        self.flush()
+        self.connection.executemany('INSERT OR REPLACE INTO class_params VALUES (?, ?)',
+                                    [(c, json.dumps(list(self._positions[c]))) for c in self._new_names])
+        self.connection.execute('INSERT INTO snapshot VALUES (?)', (self.generation,))
+        self.connection.commit()
+        self.connection.close()
+        logger.info(f"Snapshot {self.generation} of {self.path}: {self.counts['added']} added, "
+                    f"{self.counts['modified']} modified, {self.counts['removed']} removed, "
+                    f"{self.counts['unchanged']} unchanged MOs")
@@ -0,0 +1,58 @@
+import logging
+from lxml import etree
+from common.archive import is_archive, iter_members
+from common.stream import open_input
+
+logger = logging.getLogger(__name__)
+
+# root element of each export format
+root_formats = {
+    'raml': ('nokia', 'cm'),
+    'OMeS': ('nokia', 'pm'),
+    'bulkCmConfigDataFile': ('ericsson', 'cm'),
+}
+
+# the 3GPP measCollec format is shared, the vendor is told by the vendorName of its fileHeader
+meas_collec_vendors = {
+    'huawei': ('huawei', 'pm'),
+    'ericsson': ('ericsson', 'pm'),
+}
+
+
+def detect_format(path, max_elements=20):
+    """
+    Sniff the vendor and type of an export from its first elements, without reading the rest of the file.
+    Returns a (vendor, type) key or None when the format is not recognised; archives are told by their first member
+    """
+    try:
+        if is_archive(path):
+            for member in iter_members(path):
+                return detect_stream(member, max_elements)
+            return None
+        source = open_input(path)
+        with open(source, 'rb') if source is path else source as f:
+            return detect_stream(f, max_elements)
+    except (OSError, EOFError, etree.XMLSyntaxError) as ex:
+        logger.warning(f'Could not detect the format of {path}: {ex}')
+    return None
+
+
+def detect_stream(f, max_elements=20):
+    root = None
+    for n, (_, elem) in enumerate(etree.iterparse(f, events=('start',)), 1):
+        tag = etree.QName(elem).localname
+        if root is None:
+            root = tag
+            if root in root_formats:
+                return root_formats[root]
+            if root != 'measCollecFile':
+                return None
+        elif tag == 'fileHeader':
+            vendor_name = (elem.get('vendorName') or '').lower()
+            for name, key in meas_collec_vendors.items():
+                if name in vendor_name:
+                    return key
+            return None
+        if n >= max_elements:
+            return None
+    return None
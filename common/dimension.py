@@ -0,0 +1,181 @@
+import logging
+import os
+import socket
+import sqlite3
+import uuid
+import weakref
+
+logger = logging.getLogger(__name__)
+
+registry_filename = '.mo_ids.sqlite'
+dimension_table = 'MO'
+
+# registries already opened by this process, keyed by output directory
+_registries = {}
+
+
+class MoRegistry:
+    """
+    Stable integer ids of MO DNs for an output directory, kept in SQLite so that every file, run and worker
+    writing there gives a DN the same id. Ids are cached in memory once seen. The registry also records
+    which ids have their row in the MO dimension table of each output target (see MoRun)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # opened before the sink of the first run has created the output directory
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=300)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS mo (id INTEGER PRIMARY KEY, dn TEXT UNIQUE NOT NULL)')
+        # owner is the run writing the row of the id to the target, NULL once that run closed its sink
+        self.connection.execute('CREATE TABLE IF NOT EXISTS dimension (target TEXT, id INTEGER, owner TEXT, '
+                                'PRIMARY KEY (target, id))')
+        self.connection.commit()
+        self._ids = {}
+        # target -> ids whose row is written
+        self._written = {}
+        self._runs = weakref.WeakValueDictionary()
+
+    def get_ids(self, dns):
+        """
+        (ids, new): the id of each DN, and {dn: id} of the DNs registered by this call
+        """
+        ids = self._ids
+        new = {}
+        missing = []
+        for dn in dict.fromkeys(dns):
+            if dn not in ids:
+                # DNs registered by earlier runs are only read, without a write transaction
+                row = self.connection.execute('SELECT id FROM mo WHERE dn = ?', (dn,)).fetchone()
+                if row is None:
+                    missing.append(dn)
+                else:
+                    ids[dn] = row[0]
+        if missing:
+            with self.connection:
+                for dn in missing:
+                    cursor = self.connection.execute('INSERT OR IGNORE INTO mo (dn) VALUES (?)', (dn,))
+                    if cursor.rowcount:
+                        ids[dn] = new[dn] = cursor.lastrowid
+                    else:
+                        # registered meanwhile by another file or worker
+                        ids[dn] = self.connection.execute('SELECT id FROM mo WHERE dn = ?', (dn,)).fetchone()[0]
+        return [ids[dn] for dn in dns], new
+
+    def open_run(self, target):
+        run = MoRun(self, target)
+        self._runs[run.owner] = run
+        return run
+
+    def is_stale(self, owner):
+        # a run that died before closing its sink: its process is gone, or it is this process and the run ended
+        host, pid, _ = owner.split(':')
+        if host != socket.gethostname():
+            return False
+        if int(pid) == os.getpid():
+            return owner not in self._runs
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def claim(self, target, owner, ids):
+        """
+        The ids whose row the run owner has to write to target: those without a row, or whose row was being
+        written by a run that died
+        """
+        written = self._written.setdefault(target, set())
+        ids = [i for i in ids if i not in written]
+        claimed = []
+        with self.connection:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                owners = dict(self.connection.execute(
+                    f'SELECT id, owner FROM dimension WHERE target = ? AND id IN ({", ".join("?" * len(chunk))})',
+                    [target, *chunk]))
+                for i in chunk:
+                    if i not in owners:
+                        cursor = self.connection.execute('INSERT OR IGNORE INTO dimension VALUES (?, ?, ?)',
+                                                         (target, i, owner))
+                    elif owners[i] is None:
+                        written.add(i)
+                        continue
+                    elif self.is_stale(owners[i]):
+                        cursor = self.connection.execute(
+                            'UPDATE dimension SET owner = ? WHERE target = ? AND id = ? AND owner = ?',
+                            (owner, target, i, owners[i]))
+                    else:
+                        # written by a live run
+                        continue
+                    # nothing changed when another run claimed the id meanwhile
+                    if cursor.rowcount:
+                        claimed.append(i)
+        return claimed
+
+    def commit(self, target, owner):
+        with self.connection:
+            ids = [i for i, in self.connection.execute('SELECT id FROM dimension WHERE target = ? AND owner = ?',
+                                                       (target, owner))]
+            self.connection.execute('UPDATE dimension SET owner = NULL WHERE target = ? AND owner = ?',
+                                    (target, owner))
+        self._written.setdefault(target, set()).update(ids)
+
+
+class MoRun:
+    """
+    The MO ids of one parser run and the MO rows it writes to its output target. get_ids() gives the ids of
+    DNs and the {dn: id} whose rows this run writes: ids without a row in the target yet, including those
+    left by a run killed before its rows reached the disk. commit() records them as written and is only
+    called once the sink is closed
+    """
+
+    def __init__(self, registry, target):
+        self.registry = registry
+        self.target = target
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+        self._seen = set()
+
+    def get_ids(self, dns):
+        ids, _ = self.registry.get_ids(dns)
+        new = {dn: i for dn, i in zip(dns, ids) if i not in self._seen}
+        if new:
+            self._seen.update(new.values())
+            claimed = set(self.registry.claim(self.target, self.owner, list(new.values())))
+            new = {dn: i for dn, i in new.items() if i in claimed}
+        return ids, new
+
+    def commit(self):
+        self.registry.commit(self.target, self.owner)
+
+
+def get_target(output_format):
+    # part files of csv-shards are compacted into the files of csv
+    return 'csv' if output_format == 'csv-shards' else output_format
+
+
+def get_mo_registry(write_directory):
+    registry = _registries.get(write_directory)
+    if registry is None:
+        registry = _registries[write_directory] = MoRegistry(os.path.join(write_directory, registry_filename))
+    return registry
+
+
+def open_mo_run(write_directory, output_format):
+    if output_format.startswith('sqlite:'):
+        output_format = 'sqlite:' + os.path.abspath(output_format[len('sqlite:'):])
+    return get_mo_registry(write_directory).open_run(get_target(output_format))
+
+
+def write_dimension(sink, new, components):
+    """
+    Write the DNs of a run's new ids ({dn: id} from MoRun.get_ids) to the MO table, with the DN components
+    given by components(dn)
+    """
+    if new:
+        rows = [{'MO_ID': mo_id, 'DN': dn, **components(dn)} for dn, mo_id in new.items()]
+        sink.write(dimension_table, ['MO_ID', 'DN'], rows, keys=('MO_ID',))
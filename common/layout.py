@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+layout_filename = '.layouts.json'
+
+# registries already loaded by this process, keyed by output directory
+_registries = {}
+
+
+class LayoutRegistry:
+    """
+    Persistent cache of resolved column orders, keyed by vendor, measInfo/measurement id and the counter
+    list of the block. The same measInfo layout repeats in every ROP of a node type, so the column order
+    is resolved once and then reused across rows, files and runs
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._layouts = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                for vendor, table, counters, columns in json.load(f):
+                    self._layouts.setdefault((vendor, table, tuple(counters)), columns)
+        except (ValueError, TypeError) as ex:
+            logger.warning(f'Ignoring unreadable layout registry {self.path}: {ex}')
+
+    def get_columns(self, vendor, table, counters, build):
+        key = (vendor, table, tuple(counters))
+        columns = self._layouts.get(key)
+        if columns is None:
+            columns = self._layouts[key] = list(build())
+            self._dirty = True
+        return columns
+
+    def save(self):
+        if not self._dirty:
+            return
+        # keep layouts saved meanwhile by other processes writing to the same directory
+        self.load()
+        # the output directory is only created by the CSV sinks, not by a database given by path
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([[vendor, table, list(counters), columns]
+                       for (vendor, table, counters), columns in self._layouts.items()], f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+def get_registry(write_directory):
+    registry = _registries.get(write_directory)
+    if registry is None:
+        registry = _registries[write_directory] = LayoutRegistry(os.path.join(write_directory, layout_filename))
+    return registry
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+manifest_filename = '.manifest.sqlite'
+# parser options changing how a file is parsed but not its outputs
+runtime_options = ('split_workers', 'offset_index', 'pipeline')
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parser_signature(parser_class, parser_kwargs=None):
+    """
+    Identifies the parser, its version attribute and the options that shape its output;
+    a change of any of them makes the manifest parse the file again
+    """
+    options = ','.join(f'{k}={sorted(v) if isinstance(v, (list, set)) else v}'
+                       for k, v in sorted((parser_kwargs or {}).items()) if k not in runtime_options)
+    return f'{parser_class.__name__}/{getattr(parser_class, "version", 1)}/{options}'
+
+
+class Manifest:
+    """
+    Ingestion manifest kept in SQLite: one row per input, keyed by its absolute path, with its size, mtime,
+    content hash, parser signature and produced outputs. Every record is committed on its own, in WAL mode,
+    so a file is never parsed twice because the process was killed after writing its rows, and a record
+    costs the same however many files the manifest has
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # the manifest is opened before any file is parsed, its directory may not exist yet
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # the parse server records from its connection threads, one at a time
+        self.connection = sqlite3.connect(path, timeout=300, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                                'sha1 TEXT, parser TEXT, outputs TEXT, rows INTEGER, parsed_at TEXT)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, path):
+        row = self.connection.execute('SELECT * FROM files WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['outputs'] = json.loads(entry['outputs'])
+        return entry
+
+    def is_done(self, path, parser):
+        """
+        True when the file was already parsed by the same parser and did not change since:
+        size and mtime are compared first, the content hash only when they differ
+        """
+        entry = self.get(path)
+        if entry is None or entry['parser'] != parser:
+            return False
+        stat = os.stat(path)
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return True
+        if entry['size'] == stat.st_size and entry['sha1'] == file_hash(path):
+            # touched but unchanged content
+            with self.connection:
+                self.connection.execute('UPDATE files SET mtime = ? WHERE path = ?', (stat.st_mtime, entry['path']))
+            return True
+        return False
+
+    def record(self, path, parser, outputs=(), rows=0):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                path, stat.st_size, stat.st_mtime, file_hash(path), parser, json.dumps(sorted(outputs)), rows,
+                time.strftime('%Y-%m-%dT%H:%M:%S')))
+
+    def forget(self, path):
+        with self.connection:
+            self.connection.execute('DELETE FROM files WHERE path = ?', (os.path.abspath(path),))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,135 @@
+import logging
+import resource
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+stages = ('read', 'decompress', 'parse', 'transform', 'write', 'rollup')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS; it is the peak of the whole process
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+class Metrics:
+    """
+    Stage timers and row counts of one parsed file. read/decompress are timed on the input stream,
+    transform by the parsers and write by the sinks; parse is the rest of the run time, i.e. the XML
+    parsing itself plus the parser's own bookkeeping. Progress is logged at most every progress_interval
+    seconds instead of once per row. A pipelined run reads and writes on threads of their own: parse is
+    then the parsing thread's time less its waits for them (waiting), and the summary adds the utilization
+    of every stage over the run time
+    """
+
+    def __init__(self, name='', progress_interval=10.0, pipelined=False):
+        self.name = name
+        self.progress_interval = progress_interval
+        self.pipelined = pipelined
+        self.waiting = 0.0
+        self.stages = defaultdict(float)
+        self.rows = 0
+        self.seconds = None
+        self.started = time.perf_counter()
+        self._last_progress = self.started
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+
+    def add_time(self, name, seconds):
+        self.stages[name] += seconds
+
+    def add_rows(self, count):
+        self.rows += count
+        now = time.perf_counter()
+        if now - self._last_progress >= self.progress_interval:
+            self._last_progress = now
+            elapsed = now - self.started
+            logger.info(f'{self.name}: {self.rows} rows in {elapsed:.0f}s, {self.rows / elapsed:.0f} rows/s')
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+        return self
+
+    def merge(self, other):
+        # archives are measured member by member and reported as one file
+        for name, seconds in other.stages.items():
+            self.stages[name] += seconds
+        self.rows += other.rows
+        self.pipelined = self.pipelined or other.pipelined
+        self.waiting += other.waiting
+
+    def summary(self):
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self.started
+        measured = {name: self.stages[name] for name in stages if name in self.stages}
+        if self.pipelined:
+            parsing = sum(seconds for name, seconds in measured.items() if name in ('transform', 'rollup'))
+            measured['parse'] = max(seconds - parsing - self.waiting, 0.0)
+        else:
+            measured['parse'] = max(seconds - sum(measured.values()), 0.0)
+        summary = {
+            'file': self.name,
+            'seconds': round(seconds, 6),
+            'rows': self.rows,
+            'rows_per_sec': round(self.rows / seconds, 1) if seconds else 0.0,
+            'stages': {name: round(measured[name], 6) for name in stages if name in measured},
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        if self.pipelined:
+            # busy share of the run time of each stage, read/decompress and write on their own threads
+            summary['utilization'] = {name: round(measured[name] / seconds, 3) if seconds else 0.0
+                                      for name in stages if name in measured}
+        return summary
+
+
+class TimedReader:
+    """
+    Binary stream wrapper timing the reads of the parser input: the time spent in read() is the
+    decompression of gzipped inputs, or the plain file I/O otherwise
+    """
+
+    def __init__(self, stream, metrics, stage):
+        self.stream = stream
+        self.metrics = metrics
+        self.stage = stage
+        self.name = getattr(stream, 'name', '')
+
+    def read(self, size=-1):
+        started = time.perf_counter()
+        data = self.stream.read(size)
+        self.metrics.add_time(self.stage, time.perf_counter() - started)
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+def aggregate(summaries, seconds=None):
+    """
+    Batch summary of per-file summaries: totals per stage, rows/s over the batch wall time when given
+    """
+    total = {name: 0.0 for name in stages}
+    rows = 0
+    for summary in summaries:
+        rows += summary['rows']
+        for name, value in summary['stages'].items():
+            total[name] += value
+    if seconds is None:
+        seconds = sum(summary['seconds'] for summary in summaries)
+    return {
+        'files': len(summaries),
+        'seconds': round(seconds, 6),
+        'rows': rows,
+        'rows_per_sec': round(rows / seconds, 1) if seconds else 0.0,
+        'stages': {name: round(value, 6) for name, value in total.items() if value},
+        'peak_rss_mb': max((summary['peak_rss_mb'] for summary in summaries), default=0.0),
+    }
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import sqlite3
+from xml.sax.saxutils import unescape
+from common.split import SliceStream, UntrackedElements, can_split, iter_tags, iter_tracked, local_name, scan_head
+
+logger = logging.getLogger(__name__)
+
+index_suffix = '.offsets.sqlite'
+# directory of the indexes in the output directory, input directories may be read-only or shared
+index_directory_name = '.offsets'
+
+
+def encode_stack(stack):
+    # tags are kept byte for byte: latin-1 maps every byte to one character
+    return json.dumps([[name.decode('latin-1'), offset, tag.decode('latin-1')] for name, offset, tag in stack])
+
+
+def decode_stack(text):
+    return [(name.encode('latin-1'), offset, tag.encode('latin-1')) for name, offset, tag in json.loads(text)]
+
+
+def get_attribute_pattern(name):
+    return re.compile(rb'\s' + re.escape(name.encode()) + rb'\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+
+class OffsetIndex:
+    """
+    Sidecar index of the records of an XML export (measInfo, PMMOResult or managedObject elements): the
+    byte range of each one, the elements enclosing it and the values of the attributes it is selected by,
+    taken from its first tag having them. It is built by one scan of the memory-mapped file, and built
+    again whenever the file's size or modification time changes. select() gives a stream of the selected
+    records only, read straight from their offsets, as a document the parsers read like the whole file
+    """
+
+    def __init__(self, path, record_tag, context_tags=(), attributes=(), index_path=None):
+        self.path = path
+        self.record_tag = record_tag
+        self.context_tags = context_tags
+        self.attributes = attributes
+        self.index_path = index_path or get_index_path(path)
+        self.connection = sqlite3.connect(self.index_path, timeout=300)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS contexts (id INTEGER PRIMARY KEY, stack TEXT);
+            CREATE TABLE IF NOT EXISTS records (start INTEGER PRIMARY KEY, end INTEGER, context INTEGER, keys TEXT);
+            CREATE INDEX IF NOT EXISTS ix_records_keys ON records (keys);
+        ''')
+        if not self.is_current():
+            self.build()
+
+    def get_signature(self):
+        stat = os.stat(self.path)
+        return json.dumps([stat.st_size, stat.st_mtime_ns, self.record_tag, list(self.context_tags),
+                           list(self.attributes)])
+
+    def is_current(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE name = 'signature'").fetchone()
+        return row is not None and row[0] == self.get_signature()
+
+    def get_keys(self, data, start, end):
+        keys = {}
+        for name, pattern in self._patterns:
+            match = pattern.search(data, start, end)
+            if match is not None:
+                keys[name] = unescape((match.group(1) or match.group(2) or b'').decode(),
+                                      {'&quot;': '"', '&apos;': "'"})
+        return json.dumps(keys, sort_keys=True)
+
+    def build(self):
+        signature = self.get_signature()
+        self._patterns = [(name, get_attribute_pattern(name)) for name in self.attributes]
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            first = next(iter_tags(data, [self.record_tag], 0), None)
+            head_end = first[2] if first is not None else len(data)
+            head_stack = scan_head(data, head_end)
+            names = {self.record_tag, *self.context_tags, *(local_name(n) for n, _, _ in head_stack)}
+            while True:
+                try:
+                    contexts, rows = self.scan(data, names, head_end, head_stack)
+                    break
+                except UntrackedElements as ex:
+                    logger.info(f'{self.path}: also tracking {ex} elements for the index')
+                    names |= ex.names
+        with self.connection:
+            for table in ('meta', 'contexts', 'records'):
+                self.connection.execute(f'DELETE FROM {table}')
+            self.connection.executemany('INSERT INTO contexts VALUES (?, ?)', contexts.values())
+            self.connection.executemany('INSERT INTO records VALUES (?, ?, ?, ?)', rows)
+            self.connection.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('signature', signature), ('head_end', str(head_end)), ('head_stack', encode_stack(head_stack))])
+        logger.info(f'Indexed {len(rows)} {self.record_tag} elements of {self.path} in {self.index_path}')
+
+    def scan(self, data, names, head_end, head_stack):
+        record = self.record_tag.encode()
+        contexts = {}
+        rows = []
+        stack = list(head_stack)
+        # start of the record being scanned and its depth: records nested in it are part of it
+        current = None
+        for closing, name, offset, empty, end in iter_tracked(data, names, head_end):
+            is_record = name.split(b':')[-1] == record
+            if closing:
+                if not stack or stack[-1][0] != name:
+                    raise ValueError(f'{self.path}: unexpected </{name.decode()}> at byte {offset}')
+                stack.pop()
+                if current is not None and is_record and len(stack) == current[1]:
+                    rows.append((current[0], end, current[2], self.get_keys(data, current[0], end)))
+                    current = None
+                continue
+            if is_record and current is None:
+                key = tuple(o for _, o, _ in stack)
+                if key not in contexts:
+                    contexts[key] = (len(contexts) + 1, encode_stack(stack))
+                if empty:
+                    rows.append((offset, end, contexts[key][0], self.get_keys(data, offset, end)))
+                else:
+                    current = (offset, len(stack), contexts[key][0])
+            if not empty:
+                stack.append((name, offset, data[offset:end]))
+        return contexts, rows
+
+    def get_meta(self, name):
+        return self.connection.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()[0]
+
+    def select(self, selected):
+        """
+        Stream of the head of the document and the records whose keys ({attribute: value}) are selected
+        """
+        keys = [k for k, in self.connection.execute('SELECT DISTINCT keys FROM records') if selected(json.loads(k))]
+        records = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            records.extend(self.connection.execute(
+                f'SELECT start, end, context FROM records WHERE keys IN ({", ".join("?" * len(chunk))})', chunk))
+        records.sort()
+        contexts = {i: decode_stack(stack) for i, stack in self.connection.execute('SELECT id, stack FROM contexts')}
+        # enclosing elements are closed and opened between two records whenever they change
+        opened = decode_stack(self.get_meta('head_stack'))
+        pieces = [(0, int(self.get_meta('head_end')))]
+        for start, end, context in records:
+            stack = contexts[context]
+            common = 0
+            while common < min(len(opened), len(stack)) and opened[common][1] == stack[common][1]:
+                common += 1
+            pieces.append(b''.join(b'</' + name + b'>' for name, _, _ in reversed(opened[common:])))
+            pieces.append(b''.join(tag for _, _, tag in stack[common:]))
+            pieces.append((start, end))
+            opened = stack
+        pieces.append(b''.join(b'</' + name + b'>' for name, _, _ in reversed(opened)))
+        logger.info(f'Reading {len(records)} selected {self.record_tag} elements of {self.path}')
+        return SliceStream(self.path, pieces)
+
+    def close(self):
+        self.connection.close()
+
+
+def get_index_path(path, index_directory=None):
+    """
+    Index of path in index_directory, named after the file and a hash of its absolute path so that inputs of
+    the same name in other directories have indexes of their own; next to the file when index_directory is None
+    """
+    if index_directory is None:
+        return path + index_suffix
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(index_directory, f'{os.path.basename(path)}.{digest}{index_suffix}')
+
+
+def get_index_directory(offset_index, write_directory):
+    # offset_index is True for the index directory of the outputs, or the path of another one. The byte ranges
+    # read by split workers have no output directory, they are never read by offsets
+    if isinstance(offset_index, str):
+        return offset_index
+    return os.path.join(write_directory, index_directory_name) if write_directory is not None else None
+
+
+def open_selected(source, selected, record_tag, context_tags=(), attributes=(), index_directory=None):
+    """
+    The records of source selected by selected(keys), read through its index in index_directory, or source
+    itself when it cannot be read by offsets: gzipped files and archive members
+    """
+    if not can_split(source):
+        return source
+    if index_directory is not None:
+        os.makedirs(index_directory, exist_ok=True)
+    index = OffsetIndex(source, record_tag, context_tags, attributes, get_index_path(source, index_directory))
+    try:
+        return index.select(selected)
+    finally:
+        index.close()
@@ -0,0 +1,29 @@
+class Parser:
+    """
+    Options shared by the vendor parsers. A parser lists the ones it supports in options, and is given
+    them as keywords; options of its own are taken by its __init__ before the shared ones
+    """
+
+    options = ()
+
+    def __init__(self, output_format='csv', **options):
+        unsupported = sorted(set(options) - set(self.options))
+        if unsupported:
+            raise TypeError(f'{type(self).__name__} does not support {", ".join(unsupported)}')
+        self.output_format = output_format
+        self.outputs = []
+        self.metrics = None
+        # counter/measurement selection applied while parsing, None keeps everything
+        self.counters = set(options['counters']) if options.get('counters') else None
+        self.measurements = set(options['measurements']) if options.get('measurements') else None
+        # {counter: aggregation} rules of the hour/day rollups, None for no rollup
+        self.rollup = options.get('rollup')
+        # MO_ID column instead of the MO's DN components, which go to the MO dimension table
+        self.mo_ids = options.get('mo_ids', False)
+        # worker processes parsing one file by byte ranges of its records, None parses it here
+        self.split_workers = options.get('split_workers')
+        # the selected records are read through an index of their byte offsets instead of the whole file; True
+        # keeps the indexes in the output directory, a path in that directory
+        self.offset_index = options.get('offset_index', False)
+        # read, parse and write stages on threads of their own, connected by bounded queues
+        self.pipeline = options.get('pipeline', False)
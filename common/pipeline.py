@@ -0,0 +1,156 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# queue marker of the end of a stage
+_done = object()
+
+
+def put(chunks, stop, item):
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def read_ahead(stream, chunks, stop, chunk_size):
+    try:
+        while chunk := stream.read(chunk_size):
+            if not put(chunks, stop, chunk):
+                return
+    except Exception as ex:
+        put(chunks, stop, ex)
+    put(chunks, stop, _done)
+
+
+class ReadAheadStream:
+    """
+    Read stage of a pipelined run: a thread reads (and decompresses) the input in chunks ahead of the
+    parser, at most prefetch chunks. The time the parser waits for data is added to metrics.waiting.
+    The thread stops at the end of the input, or once the stream is closed or dropped by the parser
+    """
+
+    def __init__(self, stream, metrics, prefetch=16, chunk_size=1 << 20):
+        self.name = getattr(stream, 'name', '')
+        self.metrics = metrics
+        self._stream = stream
+        self._chunks = queue.Queue(prefetch)
+        self._buffer = b''
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=read_ahead, args=(stream, self._chunks, self._stop, chunk_size),
+                                        name=f'reader-{self.name}', daemon=True)
+        self._thread.start()
+
+    def __del__(self):
+        self._stop.set()
+
+    def get(self):
+        started = time.perf_counter()
+        item = self._chunks.get()
+        self.metrics.waiting += time.perf_counter() - started
+        if item is _done:
+            self._eof = True
+            return b''
+        if isinstance(item, BaseException):
+            self._eof = True
+            raise item
+        return item
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._buffer]
+            while not self._eof:
+                parts.append(self.get())
+            self._buffer = b''
+            return b''.join(parts)
+        if not self._buffer and not self._eof:
+            self._buffer = self.get()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._stream.close()
+
+
+class PipelinedSink:
+    """
+    Write stage of a pipelined run: the writes of the parser are queued, at most max_pending of them, and
+    handed to the wrapped sink by a writer thread, so formatting and file I/O overlap with the parsing.
+    The rows given must not be changed once written, which the parsers never do. A write failure is raised
+    by the next write or by close()
+    """
+
+    def __init__(self, sink, metrics, max_pending=32):
+        self.sink = sink
+        self.metrics = metrics
+        self._writes = queue.Queue(max_pending)
+        self._error = None
+        self._aborted = False
+        self._thread = threading.Thread(target=self.write_queued, name='writer', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+            return
+        # the parse failed: the queued writes are dropped and the wrapped sink is told of the failure
+        self._aborted = True
+        self._writes.put(_done)
+        self._thread.join()
+        self.sink.__exit__(exc_type, exc_val, exc_tb)
+
+    @property
+    def outputs(self):
+        return self.sink.outputs
+
+    @property
+    def rows_written(self):
+        return self.sink.rows_written
+
+    def timed(self):
+        return self.sink.timed()
+
+    def write_queued(self):
+        while (item := self._writes.get()) is not _done:
+            if self._error is not None or self._aborted:
+                # the rest is dropped, the error is raised in the parsing thread
+                continue
+            method, args, kwargs = item
+            try:
+                getattr(self.sink, method)(*args, **kwargs)
+            except Exception as ex:
+                self._error = ex
+
+    def put(self, item):
+        if self._error is not None:
+            raise self._error
+        started = time.perf_counter()
+        self._writes.put(item)
+        self.metrics.waiting += time.perf_counter() - started
+
+    def write(self, *args, **kwargs):
+        self.put(('write', args, kwargs))
+
+    def write_columns(self, *args, **kwargs):
+        self.put(('write_columns', args, kwargs))
+
+    def close(self):
+        self._writes.put(_done)
+        self._thread.join()
+        try:
+            if self._error is not None:
+                raise self._error
+        finally:
+            self.sink.close()
@@ -0,0 +1,21 @@
+import importlib
+
+# (vendor, type) -> module and class of its parser, imported on first use so that a run only pays for
+# the vendor it parses
+parser_classes = {
+    ('ericsson', 'cm'): ('Erikson.cm.parse_cm', 'Ericsson_CM'),
+    ('ericsson', 'pm'): ('Erikson.pm.parse_pm', 'Ericsson_PM'),
+    ('nokia', 'cm'): ('Nokia.cm.parse_cm', 'Nokia_CM'),
+    ('nokia', 'pm'): ('Nokia.pm.parse_pm', 'Nokia_PM'),
+    ('huawei', 'pm'): ('Huawei.pm.parse_pm', 'Huawei_PM'),
+}
+
+
+def get_parser_class(key):
+    """
+    Parser class of a (vendor, type) key, or None when there is none
+    """
+    if key not in parser_classes:
+        return None
+    module_name, class_name = parser_classes[key]
+    return getattr(importlib.import_module(module_name), class_name)
@@ -0,0 +1,405 @@
+import csv
+import fcntl
+import json
+import logging
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from itertools import repeat
+import numpy as np
+from common.sink import format_column
+
+logger = logging.getLogger(__name__)
+
+rollup_directory = 'rollup'
+
+# bucket size of each level and the length of the bucket label its CSV files are named after
+levels = {
+    'hour': (3600, 13),
+    'day': (86400, 10),
+}
+aggregations = ('sum', 'avg', 'min', 'max')
+# partial aggregates kept per MO and bucket, in their order in the stored rows
+statistics = ('sum', 'count', 'min', 'max')
+# partials of the ROPs, hours and days
+state_filename = 'rollup.sqlite'
+epoch = datetime(1970, 1, 1)
+
+
+@lru_cache(maxsize=4096)
+def parse_time(text):
+    """
+    Seconds of the wall-clock time of an export timestamp: the UTC offset is left out, so hours and days
+    are those of the network's local time
+    """
+    return int((datetime.fromisoformat(text[:19]) - epoch).total_seconds())
+
+
+@lru_cache(maxsize=256)
+def parse_duration(text):
+    # ISO 8601 durations of granPeriod/repPeriod: PT900S, PT15M, PT1H
+    match = re.fullmatch(r'PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?', text or '')
+    if match is None:
+        raise ValueError(f'Unsupported duration: {text}')
+    hours, minutes, seconds = (int(v or 0) for v in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def format_bucket(seconds):
+    return np.datetime_as_string(seconds.astype('datetime64[s]'), unit='s')
+
+
+def to_floats(texts):
+    values = np.array(texts, dtype=str)
+    values[np.isin(values, ('', 'NIL', 'None'))] = 'nan'
+    try:
+        return values.astype(np.float64)
+    except ValueError:
+        # PDF arrays and other non-numeric values are not rolled up
+        result = np.empty(len(values))
+        for i, value in enumerate(values.tolist()):
+            try:
+                result[i] = float(value)
+            except ValueError:
+                result[i] = np.nan
+        return result
+
+
+def get_stats(values):
+    """
+    Partial aggregates of raw values: missing values add 0 to the sum and are not counted
+    """
+    missing = np.isnan(values)
+    return {'sum': np.where(missing, 0.0, values), 'count': (~missing).astype(np.float64),
+            'min': values, 'max': values}
+
+
+def group(objects, buckets, stats):
+    """
+    Combine the partial aggregates of equal (object, bucket) pairs with a sort and reduceat per statistic
+    """
+    if not len(objects):
+        return objects, buckets, stats
+    order = np.lexsort((buckets, objects))
+    objects = objects[order]
+    buckets = buckets[order]
+    first = np.ones(len(objects), dtype=bool)
+    first[1:] = (objects[1:] != objects[:-1]) | (buckets[1:] != buckets[:-1])
+    starts = np.flatnonzero(first)
+    grouped = {
+        'sum': np.add.reduceat(stats['sum'][order], starts, axis=0),
+        'count': np.add.reduceat(stats['count'][order], starts, axis=0),
+        'min': np.fmin.reduceat(stats['min'][order], starts, axis=0),
+        'max': np.fmax.reduceat(stats['max'][order], starts, axis=0),
+    }
+    return objects[starts], buckets[starts], grouped
+
+
+def align(stats, names, all_names):
+    # counters missing from a block: nothing summed or counted, no min/max
+    if names == all_names:
+        return stats
+    positions = [names.index(name) if name in names else -1 for name in all_names]
+    aligned = {}
+    for key, values in stats.items():
+        fill = 0.0 if key in ('sum', 'count') else np.nan
+        result = np.full((len(values), len(all_names)), fill)
+        for i, position in enumerate(positions):
+            if position >= 0:
+                result[:, i] = values[:, position]
+        aligned[key] = result
+    return aligned
+
+
+def empty_stats(length, width):
+    # nothing summed or counted, no min/max
+    return {'sum': np.zeros((length, width)), 'count': np.zeros((length, width)),
+            'min': np.full((length, width), np.nan), 'max': np.full((length, width), np.nan)}
+
+
+def encode(stats):
+    # one blob per row, of the row's statistics one after the other
+    rows = np.ascontiguousarray(np.stack([stats[key] for key in statistics], axis=1))
+    return [row.tobytes() for row in rows]
+
+
+def decode(rows, stats):
+    """
+    Put the blobs of (position, blob) rows into the stats arrays. Partials stored before counters were appended
+    to their table are narrower: the rows are decoded together per width
+    """
+    widths = {}
+    for i, blob in rows:
+        positions, blobs = widths.setdefault(len(blob), ([], []))
+        positions.append(i)
+        blobs.append(blob)
+    for positions, blobs in widths.values():
+        values = np.frombuffer(b''.join(blobs)).reshape(len(blobs), len(statistics), -1)
+        for column, key in enumerate(statistics):
+            stats[key][positions, :values.shape[2]] = values[:, column]
+
+
+@contextmanager
+def locked(path):
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+class Rollup:
+    """
+    Time-bucket rollups of PM counters per MO: every ROP is aggregated into hours and days, with the sum, avg,
+    min or max of each counter as set by rules ({counter: aggregation}, '*' for the default, sum otherwise).
+    The partial aggregates (sum, count, min, max) of every MO and ROP, hour and day are kept in SQLite, one
+    row per MO and bucket with the counters of its table in the order they were first seen. A flush only
+    reads and writes the rows of its own MOs and buckets: its ROPs replace the partials of the same MO, ROP
+    start and counter, so a file parsed again or delivered twice is not counted twice, and the difference
+    is added to the hours and days. Only a replaced value that may have been the min or max of its hour or
+    day has that MO's hour or day grouped again from its ROPs. close() exports the hours and days updated
+    by this run, one CSV per bucket. Flushes are transactions, for workers rolling up into the same directory
+    """
+
+    def __init__(self, directory, rules=None, flush_rows=100000):
+        self.directory = directory
+        self.rules = rules or {}
+        self.flush_rows = flush_rows
+        self._blocks = {}
+        self._rows = {}
+        self._pending = 0
+        self._updated = set()
+        self._connection = None
+
+    def connect(self):
+        if self._connection is None:
+            os.makedirs(self.directory, exist_ok=True)
+            # transactions are begun explicitly, IMMEDIATE so that concurrent flushes wait for each other
+            self._connection = sqlite3.connect(os.path.join(self.directory, state_filename), timeout=300,
+                                               isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS counters (tbl TEXT PRIMARY KEY, names TEXT);
+                CREATE TABLE IF NOT EXISTS rops (tbl TEXT, object TEXT, start INTEGER, stats BLOB,
+                    PRIMARY KEY (tbl, object, start));
+                CREATE TABLE IF NOT EXISTS buckets (level TEXT, tbl TEXT, bucket INTEGER, object TEXT, stats BLOB,
+                    PRIMARY KEY (level, tbl, bucket, object));
+                CREATE TEMP TABLE IF NOT EXISTS keys (i INTEGER PRIMARY KEY, object TEXT, bucket INTEGER);
+            ''')
+        return self._connection
+
+    def add(self, table, objects, start, counters):
+        """
+        Add a column block: objects names the MO of each row, start is the ROP start in seconds (parse_time)
+        for all rows or per row, counters maps counter names to value arrays
+        """
+        objects = np.asarray(objects, dtype=str)
+        starts = np.broadcast_to(np.asarray(start, dtype=np.int64), objects.shape)
+        names = list(counters)
+        values = np.column_stack([np.asarray(counters[name], dtype=np.float64) for name in names]) \
+            if names else np.empty((len(objects), 0))
+        self._blocks.setdefault(table, []).append((objects, starts, names, values))
+        self.added(len(objects))
+
+    def add_row(self, table, obj, start, counters):
+        """
+        Add one row of counter texts, converted to floats with the other rows of the table at flush time
+        """
+        self._rows.setdefault(table, []).append((obj, start, counters))
+        self.added(1)
+
+    def added(self, count):
+        self._pending += count
+        if self._pending >= self.flush_rows:
+            self.flush()
+
+    def get_row_block(self, rows):
+        names = list(dict.fromkeys(name for _, _, counters in rows for name in counters))
+        objects = np.array([obj for obj, _, _ in rows], dtype=str)
+        starts = np.array([start for _, start, _ in rows], dtype=np.int64)
+        values = np.column_stack([to_floats([counters.get(name, '') for _, _, counters in rows]) for name in names]) \
+            if names else np.empty((len(rows), 0))
+        return objects, starts, names, values
+
+    def flush(self):
+        for table, rows in self._rows.items():
+            if rows:
+                self._blocks.setdefault(table, []).append(self.get_row_block(rows))
+        self._rows = {}
+        for table, blocks in self._blocks.items():
+            names = list(dict.fromkeys(name for block in blocks for name in block[2]))
+            objects = np.concatenate([block[0] for block in blocks])
+            starts = np.concatenate([block[1] for block in blocks])
+            aligned = [align(get_stats(values), block_names, names) for _, _, block_names, values in blocks]
+            stats = {key: np.concatenate([block[key] for block in aligned]) for key in aligned[0]}
+            self.merge(table, objects, starts, names, stats)
+        self._blocks = {}
+        self._pending = 0
+
+    def get_names(self, table, names=()):
+        """
+        Counters of a table in the order of their partials, with the new ones of names appended
+        """
+        row = self.connect().execute('SELECT names FROM counters WHERE tbl = ?', (table,)).fetchone()
+        known = json.loads(row[0]) if row else []
+        added = [name for name in names if name not in known]
+        if added:
+            known += added
+            self._connection.execute('INSERT OR REPLACE INTO counters VALUES (?, ?)', (table, json.dumps(known)))
+        return known
+
+    def merge(self, table, objects, starts, names, stats):
+        objects, starts, stats = group(objects, starts, stats)
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            all_names = self.get_names(table, names)
+            columns = [all_names.index(name) for name in names]
+            old = self.fetch('SELECT keys.i, rops.stats FROM keys CROSS JOIN rops ON rops.tbl = ? '
+                             'AND rops.object = keys.object AND rops.start = keys.bucket',
+                             (table,), objects, starts, len(all_names))
+            new = {key: values.copy() for key, values in old.items()}
+            for key, values in new.items():
+                values[:, columns] = stats[key]
+            connection.executemany('INSERT INTO rops VALUES (?, ?, ?, ?) '
+                                   'ON CONFLICT DO UPDATE SET stats = excluded.stats',
+                                   zip(repeat(table), objects.tolist(), starts.tolist(), encode(new)))
+            # a replaced value may have been the min or max of its hour and day, which the new one cannot undo
+            replaced = (old['count'][:, columns] > 0) & ((old['min'][:, columns] != stats['min'])
+                                                         | (old['max'][:, columns] != stats['max']))
+            regroup = replaced.any(axis=1)
+            delta = {'sum': new['sum'] - old['sum'], 'count': new['count'] - old['count'],
+                     'min': new['min'], 'max': new['max']}
+            for level, (size, _) in levels.items():
+                self.merge_level(level, size, table, objects, starts - starts % size, delta, regroup)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def merge_level(self, level, size, table, objects, buckets, delta, regroup):
+        """
+        Add the differences of a flush's ROPs to the partials of their buckets, and group again from the ROPs
+        the buckets of the MOs having a replaced value
+        """
+        regrouped = set(zip(objects[regroup].tolist(), buckets[regroup].tolist()))
+        objects, buckets, delta = group(objects, buckets, delta)
+        width = delta['sum'].shape[1]
+        stats = self.fetch('SELECT keys.i, buckets.stats FROM keys CROSS JOIN buckets ON buckets.level = ? '
+                           'AND buckets.tbl = ? AND buckets.bucket = keys.bucket AND buckets.object = keys.object',
+                           (level, table), objects, buckets, width)
+        stats['sum'] += delta['sum']
+        stats['count'] += delta['count']
+        stats['min'] = np.fmin(stats['min'], delta['min'])
+        stats['max'] = np.fmax(stats['max'], delta['max'])
+        if regrouped:
+            rows = np.array([pair in regrouped for pair in zip(objects.tolist(), buckets.tolist())])
+            for key, values in self.regroup(table, size, objects[rows], buckets[rows], width).items():
+                stats[key][rows] = values
+        self._connection.executemany('INSERT INTO buckets VALUES (?, ?, ?, ?, ?) '
+                                     'ON CONFLICT DO UPDATE SET stats = excluded.stats',
+                                     zip(repeat(level), repeat(table), buckets.tolist(), objects.tolist(),
+                                         encode(stats)))
+        self._updated.update((level, table, bucket) for bucket in np.unique(buckets).tolist())
+
+    def fetch(self, query, parameters, objects, buckets, width):
+        """
+        Stored partials of (object, bucket) pairs, as arrays of width counters; empty for pairs not stored.
+        The pairs are looked up in one query, joined from the keys table
+        """
+        stats = empty_stats(len(objects), width)
+        self.set_keys(objects, buckets)
+        decode(self._connection.execute(query, parameters), stats)
+        return stats
+
+    def set_keys(self, objects, buckets):
+        self._connection.execute('DELETE FROM keys')
+        self._connection.executemany('INSERT INTO keys VALUES (?, ?, ?)',
+                                     zip(range(len(objects)), objects.tolist(), buckets.tolist()))
+
+    def regroup(self, table, size, objects, buckets, width):
+        """
+        Partials of (object, bucket) pairs grouped again from the stored ROPs of their buckets
+        """
+        self.set_keys(objects, buckets)
+        rows = self._connection.execute('SELECT keys.i, rops.stats FROM keys CROSS JOIN rops ON rops.tbl = ? '
+                                        'AND rops.object = keys.object AND rops.start >= keys.bucket '
+                                        'AND rops.start < keys.bucket + ?', (table, size)).fetchall()
+        rops = empty_stats(len(rows), width)
+        decode(enumerate(blob for _, blob in rows), rops)
+        # every pair has the ROPs just stored: the groups of the key positions are the pairs in order
+        positions = np.array([i for i, _ in rows], dtype=np.int64)
+        return group(positions, np.zeros(len(rows), dtype=np.int64), rops)[2]
+
+    def get_path(self, level, table, bucket):
+        directory = os.path.join(self.directory, level, table)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, str(format_bucket(np.array(bucket)))[:levels[level][1]])
+
+    def close(self):
+        """
+        Merge what is left and export the CSV of every bucket updated by this run, once
+        """
+        self.flush()
+        for level, table, bucket in sorted(self._updated):
+            self.export(level, table, bucket)
+        self._updated.clear()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def export(self, level, table, bucket):
+        path = self.get_path(level, table, bucket)
+        # the bucket is read under the lock of its CSV: the last writer of the file has read the last flush
+        with locked(path):
+            names = self.get_names(table)
+            rows = self._connection.execute('SELECT object, stats FROM buckets WHERE level = ? AND tbl = ? '
+                                            'AND bucket = ? ORDER BY object', (level, table, bucket)).fetchall()
+            stats = empty_stats(len(rows), len(names))
+            decode(enumerate(blob for _, blob in rows), stats)
+            objects = np.array([obj for obj, _ in rows], dtype=str)
+            self.write_csv(path, objects, np.full(len(rows), bucket, dtype=np.int64), names, stats)
+
+    def write_csv(self, path, objects, buckets, names, stats):
+        columns = {'MO': objects.tolist(), 'bucket': format_bucket(buckets).tolist()}
+        for i, name in enumerate(names):
+            columns[name] = format_column(self.get_values(name, i, stats))
+        with open(f'{path}.tmp.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(zip(*columns.values()))
+        os.replace(f'{path}.tmp.csv', f'{path}.csv')
+
+    def get_values(self, name, i, stats):
+        aggregation = self.rules.get(name, self.rules.get('*', 'sum'))
+        count = stats['count'][:, i]
+        if aggregation == 'avg':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = stats['sum'][:, i] / count
+        else:
+            values = stats[aggregation][:, i]
+        # a counter without any value in the bucket stays empty
+        return np.where(count > 0, values, np.nan)
+
+
+def make_rollup(write_directory, rules):
+    # rules is None when the parser does not roll up
+    return None if rules is None else Rollup(os.path.join(write_directory, rollup_directory), rules)
+
+
+def read_rules(path):
+    """
+    Aggregation of each counter from a CSV of counter,aggregation lines; '*' sets the default
+    """
+    rules = {}
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith('#'):
+                continue
+            counter, aggregation = (value.strip() for value in row[:2])
+            if aggregation not in aggregations:
+                raise ValueError(f'{path}: unknown aggregation {aggregation} of {counter}')
+            rules[counter] = aggregation
+    return rules
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import stat
+import threading
+from multiprocessing import Pool
+from common.batch import check_output_format, parse_file
+from common.manifest import Manifest, parser_signature
+from common.registry import get_parser_class
+
+logger = logging.getLogger(__name__)
+
+
+def _start_worker(keys):
+    # signals sent to the whole process group stop the server, which then closes the pool: a worker killed
+    # meanwhile would be replaced by a fork of the threaded server. Workers import their parsers up front
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    for key in keys:
+        get_parser_class(key)
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove the socket left at socket_path by a server that was killed. Anything else there is left alone:
+    a socket still accepting connections belongs to a running server, and other files are not ours
+    """
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError(f'{socket_path} exists and is not a socket')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+            return
+    raise ValueError(f'{socket_path}: a parse server is already listening')
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    One JSON job per line, answered by one JSON result line, until the client closes the connection
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                result = self.server.run_job(json.loads(line))
+            except Exception as ex:
+                logger.exception('Invalid job')
+                result = {'error': repr(ex)}
+            self.wfile.write(json.dumps(result).encode() + b'\n')
+            self.wfile.flush()
+
+
+class ParseServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Long-lived parse server on a Unix socket, so that callers parsing one file at a time pay the interpreter
+    start and the parser imports once instead of once per file. A job is
+    {"vendor", "type", "path", "write_directory", "parser_kwargs", "manifest", "force"}; it is parsed by a
+    pool of workers keeping their parser instances warm, as in --batch. Connections are served on threads
+    of their own, so jobs of several clients are parsed side by side, up to the number of workers.
+    Manifests are kept open across jobs and flushed when the server stops
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers=None, preload=()):
+        remove_stale_socket(socket_path)
+        self.socket_path = socket_path
+        self.workers = workers or os.cpu_count()
+        self._manifests = {}
+        self._lock = threading.Lock()
+        # the pool is forked before any connection thread exists
+        self.pool = Pool(self.workers, initializer=_start_worker, initargs=(list(preload),))
+        super().__init__(socket_path, JobHandler)
+
+    def get_manifest(self, path):
+        manifest = self._manifests.get(path)
+        if manifest is None:
+            manifest = self._manifests[path] = Manifest(path)
+        return manifest
+
+    def run_job(self, job):
+        key = (job.get('vendor'), job.get('type'))
+        parser_class = get_parser_class(key)
+        if parser_class is None:
+            return {'error': f'No parser for vendor {key[0]} and type {key[1]}'}
+        path = job['path']
+        parser_kwargs = job.get('parser_kwargs') or {}
+        # jobs of other clients are parsed by the other workers at the same time
+        check_output_format(parser_kwargs, self.workers)
+        signature = parser_signature(parser_class, parser_kwargs)
+        manifest_path = job.get('manifest')
+        if manifest_path is not None and not job.get('force'):
+            with self._lock:
+                if self.get_manifest(manifest_path).is_done(path, signature):
+                    return {'path': path, 'skipped': True}
+        task = (parser_class, parser_kwargs, path, job['write_directory'])
+        path, rows, elapsed, error, outputs, metrics = self.pool.apply(parse_file, (task,))
+        if error is None and manifest_path is not None:
+            with self._lock:
+                self.get_manifest(manifest_path).record(path, signature, outputs, rows)
+        logger.info(f'{path}: {error or f"{rows} rows"} in {elapsed:.2f}s')
+        return {'path': path, 'rows': rows, 'elapsed': elapsed, 'error': error, 'outputs': outputs,
+                'metrics': metrics}
+
+    def serve(self):
+        logger.info(f'Serving parse jobs on {self.socket_path} with {self.workers} workers')
+        # shutdown() waits for serve_forever to return, it cannot be called from its own thread
+        stop = lambda signum, frame: threading.Thread(target=self.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+        self.pool.join()
+        with self._lock:
+            for manifest in self._manifests.values():
+                manifest.close()
+            self._manifests.clear()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
@@ -0,0 +1,324 @@
+import csv
+import io
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+
+def format_column(values):
+    """
+    Convert a decoded column (list or float ndarray) into CSV cell values: NaN becomes an empty cell and
+    whole numbers are written without a trailing .0
+    """
+    if getattr(values, 'dtype', None) is None or values.dtype.kind != 'f':
+        return values
+    missing = values != values
+    present = values[~missing]
+    if (present == present.round()).all() and (abs(present) < 2 ** 53).all():
+        whole = values.copy()
+        whole[missing] = 0
+        cells = whole.astype('int64').tolist()
+    else:
+        cells = [int(v) if v.is_integer() else v for v in values.tolist()]
+    if missing.any():
+        cells = ['' if m else v for v, m in zip(cells, missing.tolist())]
+    return cells
+
+
+class CsvSink:
+    """
+    Shared CSV output for the parsers: rows are formatted into a buffer per target file and appended
+    in large batches through an LRU pool of open files, instead of reopening the file for every row.
+    Rows are always written in the column order of the file header. A column the header does not have
+    yet is appended to it; rows already on disk are padded by a single rewrite of the file at the next
+    flush, however many columns were added in between
+    """
+
+    def __init__(self, write_directory, max_open_files=64, flush_rows=10000, metrics=None):
+        self.write_directory = write_directory
+        os.makedirs(write_directory, exist_ok=True)
+        self.metrics = metrics
+        self.max_open_files = max_open_files
+        self.flush_rows = flush_rows
+        self.rows_written = 0
+        self._files = OrderedDict()
+        self._buffers = {}
+        self._writers = {}
+        self._headers = {}
+        self._columns = {}
+        self._disk_width = {}
+        self._buffer_width = {}
+        self._pending = {}
+        self._pending_total = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def timed(self):
+        return nullcontext() if self.metrics is None else self.metrics.stage('write')
+
+    def get_path(self, table):
+        return os.path.join(self.write_directory, f'{table}.csv')
+
+    @property
+    def outputs(self):
+        return list(self._buffers)
+
+    def read_header(self, path):
+        with open(path, newline='') as csvfile:
+            return next(csv.reader(csvfile), [])
+
+    def open_table(self, path, fieldnames):
+        buffer = self._buffers[path] = io.StringIO()
+        self._pending[path] = 0
+        # the output directory is only checked once per target file and sink
+        if os.path.isfile(path):
+            header = self.read_header(path)
+            self._disk_width[path] = len(header)
+        else:
+            header = list(fieldnames)
+            self._disk_width[path] = None
+        self._buffer_width[path] = None
+        self._headers[path] = header
+        self._columns[path] = set(header)
+        self._writers[path] = csv.DictWriter(buffer, fieldnames=header)
+
+    def evolve_header(self, path, columns):
+        header = self._headers[path]
+        new_columns = [c for c in dict.fromkeys(columns) if c not in self._columns[path]]
+        if not new_columns:
+            return
+        logger.debug(f'Adding columns {new_columns} to {path}')
+        header.extend(new_columns)
+        self._columns[path].update(new_columns)
+        self._writers[path] = csv.DictWriter(self._buffers[path], fieldnames=header)
+
+    def rewrite_file(self, path):
+        csvfile = self._files.pop(path, None)
+        if csvfile is not None:
+            csvfile.close()
+        # new columns are only ever appended, so existing rows just need padding; the file is swapped atomically
+        header = self._headers[path]
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(path, newline='') as src, open(tmp_path, 'w', newline='') as dst:
+            reader = csv.reader(src)
+            writer = csv.writer(dst)
+            next(reader, None)
+            writer.writerow(header)
+            for row in reader:
+                writer.writerow(row + [''] * (len(header) - len(row)))
+        os.replace(tmp_path, path)
+        self._disk_width[path] = len(header)
+
+    def write(self, table, fieldnames, rows, keys=(), times=(), measurement=None):
+        # keys and times name the MO and time columns and measurement the measInfo of the rows,
+        # only used by the database sinks
+        with self.timed():
+            path = self.get_path(table)
+            self.prepare(path, fieldnames)
+            writer = self._writers[path]
+            count = 0
+            for row in rows:
+                try:
+                    writer.writerow(row)
+                except ValueError:
+                    # the row has keys outside of the header
+                    self.evolve_header(path, row)
+                    writer = self._writers[path]
+                    writer.writerow(row)
+                count += 1
+                if count >= self.flush_rows:
+                    # rows given by a generator are flushed as they come rather than buffered whole
+                    self.added(path, count)
+                    count = 0
+                    if self._buffer_width[path] is None:
+                        self._buffer_width[path] = len(self._headers[path])
+            self.added(path, count)
+
+    def write_columns(self, table, fieldnames, columns, keys=(), times=(), measurement=None):
+        """
+        Write a column-oriented block: columns maps a column name to a list or ndarray of equal length
+        """
+        with self.timed():
+            path = self.get_path(table)
+            self.prepare(path, fieldnames)
+            count = len(next(iter(columns.values()), ()))
+            blank = [''] * count
+            values = [format_column(columns[c]) if c in columns else blank for c in self._headers[path]]
+            csv.writer(self._buffers[path]).writerows(zip(*values))
+            self.added(path, count)
+
+    def prepare(self, path, fieldnames):
+        if path not in self._buffers:
+            self.open_table(path, fieldnames)
+        if not self._columns[path].issuperset(fieldnames):
+            self.evolve_header(path, fieldnames)
+        if self._buffer_width[path] is None:
+            self._buffer_width[path] = len(self._headers[path])
+
+    def added(self, path, count):
+        self._pending[path] += count
+        self._pending_total += count
+        self.rows_written += count
+        if self.metrics is not None:
+            self.metrics.add_rows(count)
+        if self._pending[path] >= self.flush_rows:
+            self.flush_file(path)
+        elif self._pending_total >= self.flush_rows * 10:
+            self.flush()
+
+    def get_file(self, path):
+        csvfile = self._files.get(path)
+        if csvfile is not None:
+            self._files.move_to_end(path)
+            return csvfile
+        if len(self._files) >= self.max_open_files:
+            _, oldest = self._files.popitem(last=False)
+            oldest.close()
+        csvfile = self._files[path] = open(path, 'a', newline='')
+        return csvfile
+
+    def flush_file(self, path):
+        buffer = self._buffers[path]
+        header = self._headers[path]
+        if self._disk_width[path] is not None and self._disk_width[path] < len(header):
+            self.rewrite_file(path)
+        if buffer.tell() or self._disk_width[path] is None:
+            csvfile = self.get_file(path)
+            if self._disk_width[path] is None:
+                csv.writer(csvfile).writerow(header)
+                self._disk_width[path] = len(header)
+            if self._buffer_width[path] is not None and self._buffer_width[path] < len(header):
+                # rows buffered before the header grew are shorter than the header
+                writer = csv.writer(csvfile)
+                for row in csv.reader(io.StringIO(buffer.getvalue())):
+                    writer.writerow(row + [''] * (len(header) - len(row)))
+            else:
+                csvfile.write(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+        self._buffer_width[path] = None
+        self._pending_total -= self._pending[path]
+        self._pending[path] = 0
+
+    def flush(self):
+        for path in self._buffers:
+            self.flush_file(path)
+        for csvfile in self._files.values():
+            csvfile.flush()
+
+    def close(self):
+        with self.timed():
+            self.flush()
+            for csvfile in self._files.values():
+                csvfile.close()
+            self._files.clear()
+        logger.info(f'Wrote {self.rows_written} rows to {len(self._buffers)} files in {self.write_directory}')
+
+    def abort(self):
+        """
+        Close the sink of a failed parse. The rows already appended to the shared files stay there
+        """
+        self.close()
+
+
+# time and key columns of a sharded table, next to its part files
+sort_columns_filename = 'keys.json'
+
+
+class ShardedCsvSink(CsvSink):
+    """
+    CSV output for many processes writing to the same directory: every sink writes its own part file per
+    table, {table}/part-{id}.csv, so writers never share a file and need no lock. A part file is written as
+    .csv.part and renamed on close, the compaction (common.compact) only takes the finished ones. The time
+    and key columns of each table are kept in {table}/keys.json for the compaction to sort by
+    """
+
+    def __init__(self, write_directory, **kwargs):
+        super().__init__(write_directory, **kwargs)
+        self.shard = uuid.uuid4().hex
+        self._sort_columns = {}
+
+    def get_path(self, table):
+        directory = os.path.join(self.write_directory, table)
+        if table not in self._sort_columns:
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f'part-{self.shard}.csv.part')
+
+    @property
+    def outputs(self):
+        return [path[:-len('.part')] for path in self._buffers]
+
+    def write(self, table, fieldnames, rows, keys=(), times=(), measurement=None):
+        super().write(table, fieldnames, rows)
+        self._sort_columns.setdefault(table, (times, keys))
+
+    def write_columns(self, table, fieldnames, columns, keys=(), times=(), measurement=None):
+        super().write_columns(table, fieldnames, columns)
+        self._sort_columns.setdefault(table, (times, keys))
+
+    def close(self):
+        super().close()
+        for path in self._buffers:
+            os.replace(path, path[:-len('.part')])
+        for table, (times, keys) in self._sort_columns.items():
+            write_sort_columns(os.path.join(self.write_directory, table), times, keys)
+
+    def abort(self):
+        # the part files of a failed parse are removed unpublished, a retry writes all of its rows again
+        for csvfile in self._files.values():
+            csvfile.close()
+        self._files.clear()
+        for path in self._buffers:
+            if os.path.isfile(path):
+                os.remove(path)
+        logger.info(f'Removed the {len(self._buffers)} unfinished part files of {self.shard} in {self.write_directory}')
+
+
+def write_sort_columns(directory, times, keys):
+    path = os.path.join(directory, sort_columns_filename)
+    if os.path.isfile(path):
+        return
+    # every writer of the table writes the same columns, the last rename wins
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'times': list(times), 'keys': list(keys)}, f)
+    os.replace(tmp_path, path)
+
+
+output_formats = ('csv', 'csv-shards', 'parquet', 'feather', 'sqlite')
+
+
+def make_sink(write_directory, output_format='csv', metrics=None):
+    sink = create_sink(write_directory, output_format, metrics)
+    if metrics is not None and metrics.pipelined:
+        # the writes of a pipelined run are made by a writer thread
+        from common.pipeline import PipelinedSink
+        return PipelinedSink(sink, metrics)
+    return sink
+
+
+def create_sink(write_directory, output_format='csv', metrics=None):
+    if output_format == 'csv':
+        return CsvSink(write_directory, metrics=metrics)
+    if output_format == 'csv-shards':
+        return ShardedCsvSink(write_directory, metrics=metrics)
+    if output_format in ('parquet', 'feather'):
+        # pandas/pyarrow are only imported when a columnar format is requested
+        from common.columnar import ColumnarSink
+        return ColumnarSink(write_directory, output_format, metrics=metrics)
+    if output_format == 'sqlite' or output_format.startswith('sqlite:'):
+        from common.sqlite import SqliteSink, get_database_path
+        return SqliteSink(get_database_path(output_format, write_directory), metrics=metrics)
+    raise ValueError(f'Unknown output format: {output_format}')
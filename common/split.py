@@ -0,0 +1,292 @@
+import heapq
+import logging
+import mmap
+import os
+import re
+from collections import deque
+from multiprocessing import Pool, Queue
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+# start and end tags of the document head, whatever their name: (/, name, attributes, /)
+_any_tag = re.compile(rb'<(/?)([A-Za-z_][\w.:-]*)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/?)>')
+# rest of a start tag after its name, and what may precede a tracked name after <
+_tag_end = re.compile(rb'(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+_tag_start = re.compile(rb'/?(?:[A-Za-z_][\w.-]*:)?')
+
+
+def iter_names(data, names, start):
+    # one literal search per local name, much faster than an alternation, merged in document order
+    searches = [re.compile(re.escape(name.encode()) + rb'(?=[\s/>])').finditer(data, start) for name in sorted(names)]
+    return heapq.merge(*searches, key=lambda match: match.start())
+
+
+def iter_tags(data, names, start):
+    """
+    Yield (closing, name, offset, empty, end) for the start and end tags of the given local names
+    """
+    for match in iter_names(data, names, start):
+        position = match.start()
+        opening = data.rfind(b'<', max(position - 64, start), position)
+        if opening < 0 or not _tag_start.fullmatch(data, opening + 1, position):
+            # the name in a text or an attribute value
+            continue
+        closing = data[opening + 1] == ord('/')
+        name = data[opening + 1 + closing:match.end()]
+        if closing:
+            yield True, name, opening, False, data.find(b'>', match.end()) + 1
+            continue
+        end = _tag_end.match(data, match.end())
+        if end is None:
+            continue
+        yield False, name, opening, bool(end.group(1)), end.end()
+
+
+def local_name(name):
+    return name.split(b':')[-1].decode()
+
+
+class UntrackedElements(Exception):
+    """
+    Raised by iter_tracked when a tracked start tag is inside elements of other names, given by names
+    """
+
+    def __init__(self, names):
+        super().__init__(', '.join(sorted(names)))
+        self.names = names
+
+
+def untracked_depth(data, start, end):
+    # elements opened minus elements closed by the tags between start and end, i.e. by the untracked ones
+    gap = data[start:end]
+    return gap.count(b'<') - 2 * gap.count(b'</') - gap.count(b'<!') - gap.count(b'<?') - gap.count(b'/>')
+
+
+def get_open_names(data, start, end):
+    return {local_name(name) for name, _, _ in scan_head(data, end, start)}
+
+
+def iter_tracked(data, names, start):
+    """
+    Yield the tags of names like iter_tags, checking that no element of another name encloses them: the
+    tags in between are counted, and at a start tag inside elements of other names UntrackedElements is
+    raised with their names, for the caller to scan again tracking them as well
+    """
+    depth = 0
+    position = settled = start
+    for closing, name, offset, empty, end in iter_tags(data, names, start):
+        depth += untracked_depth(data, position, offset)
+        position = end
+        if depth and not closing:
+            untracked = get_open_names(data, settled, offset) - set(names)
+            if untracked:
+                raise UntrackedElements(untracked)
+            # the count was thrown off by a comment or CDATA section, no element is open
+            depth = 0
+        if not depth:
+            settled = end
+        yield closing, name, offset, empty, end
+
+
+class SliceStream:
+    """
+    Binary stream of pieces of a file, each a (start, end) byte range of it or bytes of its own, e.g. the
+    tags reopening the elements enclosing a range. name is the file's, so the parsers write the same
+    FileName as for the whole file
+    """
+
+    def __init__(self, path, pieces, chunk_size=1 << 20):
+        self.name = path
+        self._file = open(path, 'rb')
+        self._pieces = deque(piece for piece in pieces if piece)
+        self.chunk_size = chunk_size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        while self._pieces:
+            piece = self._pieces[0]
+            if isinstance(piece, bytes):
+                data = piece[:size]
+                if len(piece) > size:
+                    self._pieces[0] = piece[size:]
+                else:
+                    self._pieces.popleft()
+                return data
+            start, end = piece
+            self._file.seek(start)
+            data = self._file.read(min(size, end - start))
+            if start + len(data) < end and data:
+                self._pieces[0] = (start + len(data), end)
+            else:
+                self._pieces.popleft()
+            if data:
+                return data
+        self._file.close()
+        return b''
+
+
+def scan_head(data, end, start=0):
+    """
+    Elements opened after start that are still open at end, as (name, offset, start tag) from the outermost
+    """
+    stack = []
+    for match in _any_tag.finditer(data, start, end):
+        closing, name, _, empty = match.groups()
+        if closing:
+            if stack and stack[-1][0] == name:
+                stack.pop()
+        elif not empty:
+            stack.append((name, match.start(), match.group()))
+    return stack
+
+
+def find_ranges(path, record_tag, context_tags=(), range_bytes=16 * 1024 * 1024):
+    """
+    Split a file into ranges starting at a record start tag, about range_bytes each: a list of
+    (start, end, prefix, suffix). The elements enclosing a split point are tracked from the start tags of
+    record_tag, context_tags and the elements open before the first record, so each range is parsed as a
+    document of its own, with the document head and the start tags of its enclosing elements as prefix
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        first = next(iter_tags(data, [record_tag], 0), None)
+        if first is None or size <= range_bytes:
+            return [(0, size, b'', b'')]
+        head_end = first[2]
+        head_stack = scan_head(data, head_end)
+        names = {record_tag, *context_tags, *(local_name(n) for n, _, _ in head_stack)}
+        while True:
+            try:
+                splits = get_splits(path, data, names, record_tag, head_end, head_stack, range_bytes)
+                break
+            except UntrackedElements as ex:
+                logger.info(f'{os.path.basename(path)}: also tracking {ex} elements for splitting')
+                names |= ex.names
+        head = data[:head_end]
+    ranges = []
+    for i, (start, enclosing) in enumerate(splits):
+        end, closing = splits[i + 1] if i + 1 < len(splits) else (size, [])
+        suffix = b''.join(b'</' + name + b'>' for name, _, _ in reversed(closing))
+        if start == 0:
+            ranges.append((0, end, b'', suffix))
+            continue
+        # the head up to the first of its open elements that is closed at start, then the other enclosing tags
+        common = 0
+        while common < min(len(head_stack), len(enclosing)) and head_stack[common][1] == enclosing[common][1]:
+            common += 1
+        cut = head_stack[common][1] if common < len(head_stack) else len(head)
+        prefix = head[:cut] + b''.join(tag for _, _, tag in enclosing[common:])
+        ranges.append((start, end, prefix, suffix))
+    return ranges
+
+
+def get_splits(path, data, names, record_tag, head_end, head_stack, range_bytes):
+    # (offset, enclosing elements) of the record start tags where a new range begins
+    record = record_tag.encode()
+    stack = list(head_stack)
+    splits = [(0, [])]
+    target = head_end + range_bytes
+    for closing, name, offset, empty, end in iter_tracked(data, names, head_end):
+        if closing:
+            if not stack or stack[-1][0] != name:
+                raise ValueError(f'{path}: unexpected </{name.decode()}> at byte {offset}, '
+                                 f'its start tag is not tracked for splitting')
+            stack.pop()
+            continue
+        if offset >= target and name.split(b':')[-1] == record:
+            splits.append((offset, list(stack)))
+            target = offset + range_bytes
+        if not empty:
+            stack.append((name, offset, data[offset:end]))
+    return splits
+
+
+# records sent back by a worker at a time, and chunks queued per range before the worker waits for the reader
+chunk_records = 1000
+queued_chunks = 16
+# files smaller than this are parsed in the calling process: starting the workers and sending the records back
+# costs more than parsing them in parallel saves
+split_min_bytes = 64 * 1024 * 1024
+
+# queues of the worker processes, one per range being parsed ahead, set by init_worker
+_queues = None
+
+
+def init_worker(queues):
+    global _queues
+    _queues = queues
+
+
+def read_range(task):
+    """
+    Pool task: (slot, parser, method, path, start, end, prefix, suffix). The records of the range are put
+    on queue slot in lists of chunk_records, followed by None, or by the exception that ended the parse
+    """
+    slot, parser, method, path, start, end, prefix, suffix = task
+    queue = _queues[slot]
+    parser.metrics = None
+    try:
+        chunk = []
+        for record in getattr(parser, method)(SliceStream(path, [prefix, (start, end), suffix])):
+            chunk.append(record)
+            if len(chunk) >= chunk_records:
+                queue.put(chunk)
+                chunk = []
+        if chunk:
+            queue.put(chunk)
+    except etree.XMLSyntaxError as ex:
+        # lxml errors cannot be sent back from the worker
+        queue.put(ValueError(f'{path}: bytes {start}-{end}: {ex}'))
+    except Exception as ex:
+        queue.put(ex)
+    queue.put(None)
+
+
+def iter_queue(queue, metrics):
+    while True:
+        if metrics is None:
+            chunk = queue.get()
+        else:
+            # the time spent waiting for the workers and unpickling their records is the read stage of the run
+            with metrics.stage('read'):
+                chunk = queue.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield from chunk
+
+
+def can_split(path):
+    return isinstance(path, str) and not path.lower().endswith('.gz') and os.path.isfile(path)
+
+
+def read_split(parser, method, path, workers, record_tag, context_tags=(), range_bytes=16 * 1024 * 1024,
+               min_bytes=split_min_bytes):
+    """
+    Yield the records of parser.method(path) in document order, with the file parsed by workers processes
+    range by range. The workers stream the records back in chunks, through a bounded queue per range: at
+    most workers + 1 ranges are parsed ahead of the one being consumed, and each of them waits once it has
+    queued_chunks chunks the reader has not taken. Inputs that cannot be read by range, gzipped files and
+    archive members, and files smaller than min_bytes are parsed by parser.method in this process
+    """
+    if not can_split(path) or os.path.getsize(path) < min_bytes:
+        yield from getattr(parser, method)(path)
+        return
+    ranges = find_ranges(path, record_tag, context_tags, range_bytes)
+    logger.info(f'Parsing {os.path.basename(path)} in {len(ranges)} ranges with {workers} workers')
+    # range i is queued on slot i % slots, whose previous range has been read whole by then
+    slots = workers + 1
+    queues = [Queue(queued_chunks) for _ in range(slots)]
+    with Pool(workers, init_worker, (queues,)) as pool:
+        pending = deque()
+        for i, r in enumerate(ranges):
+            pending.append(pool.apply_async(read_range, ((i % slots, parser, method, path, *r),)))
+            if len(pending) >= slots:
+                yield from iter_queue(queues[(i + 1 - len(pending)) % slots], parser.metrics)
+                pending.popleft().get()
+        while pending:
+            yield from iter_queue(queues[(len(ranges) - len(pending)) % slots], parser.metrics)
+            pending.popleft().get()
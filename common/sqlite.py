@@ -0,0 +1,189 @@
+import logging
+import os
+import sqlite3
+from contextlib import nullcontext
+from common.sink import format_column
+
+logger = logging.getLogger(__name__)
+
+default_database = 'parsed.sqlite'
+
+
+def quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def sql_column(values):
+    # decoded counters: NaN is stored as NULL instead of an empty string
+    if getattr(values, 'dtype', None) is not None and values.dtype.kind == 'f':
+        return [None if v == '' else v for v in format_column(values)]
+    return values
+
+
+class SqliteSink:
+    """
+    SQLite output with the interface of CsvSink: one table per measurement or MO class in a single
+    database in WAL mode. Rows are buffered and inserted with executemany, flush_rows rows per transaction;
+    columns missing from a table are added as they appear. The MO key and time columns passed with the
+    rows are indexed once the load is done, when the sink is closed
+    """
+
+    def __init__(self, path, flush_rows=10000, metrics=None):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.metrics = metrics
+        self.rows_written = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # a pipelined run writes from its writer thread
+        self.connection = sqlite3.connect(path, timeout=300, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self._columns = {}
+        self._rows = {}
+        self._indexes = {}
+        self._sql_names = {}
+        self._taken = {}
+        self._pending_total = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def timed(self):
+        return nullcontext() if self.metrics is None else self.metrics.stage('write')
+
+    @property
+    def outputs(self):
+        return [f'{self.path}:{table}' for table in self._columns]
+
+    def get_table(self, table, measurement):
+        # SQLite tables are limited to 2000 columns: tables grouping measurements are split by measurement
+        return f'{table}.{measurement}' if measurement else table
+
+    def write(self, table, fieldnames, rows, keys=(), times=(), measurement=None):
+        with self.timed():
+            table = self.get_table(table, measurement)
+            columns = self.prepare(table, fieldnames, keys, times)
+            rows = list(rows)
+            for row in rows:
+                if len(row) > len(columns) or not columns.keys() >= row.keys():
+                    columns.update(dict.fromkeys(row))
+            names = tuple(columns)
+            self.buffer(table, names, [tuple(row.get(c) for c in names) for row in rows])
+
+    def write_columns(self, table, fieldnames, columns, keys=(), times=(), measurement=None):
+        """
+        Write a column-oriented block: columns maps a column name to a list or ndarray of equal length
+        """
+        with self.timed():
+            table = self.get_table(table, measurement)
+            self.prepare(table, fieldnames, keys, times)
+            self._columns[table].update(dict.fromkeys(columns))
+            names = tuple(columns)
+            self.buffer(table, names, list(zip(*(sql_column(columns[name]) for name in names))))
+
+    def prepare(self, table, fieldnames, keys, times):
+        if table not in self._columns:
+            self._columns[table] = {}
+            self._rows[table] = []
+        self._columns[table].update(dict.fromkeys(fieldnames))
+        if keys or times:
+            self._indexes.setdefault(table, (tuple(keys), tuple(times)))
+        return self._columns[table]
+
+    def buffer(self, table, names, rows):
+        # rows are kept as tuples, in batches of the same columns inserted with one executemany
+        batches = self._rows[table]
+        if batches and batches[-1][0] == names:
+            batches[-1][1].extend(rows)
+        else:
+            batches.append((names, rows))
+        self.added(len(rows))
+
+    def added(self, count):
+        self.rows_written += count
+        self._pending_total += count
+        if self.metrics is not None:
+            self.metrics.add_rows(count)
+        if self._pending_total >= self.flush_rows:
+            self.flush()
+
+    def get_table_columns(self, table):
+        return [row[1] for row in self.connection.execute(f'PRAGMA table_info({quote(table)})')]
+
+    def get_sql_name(self, table, column):
+        names = self._sql_names[table]
+        sql_name = names.get(column)
+        if sql_name is None:
+            # SQLite column names are case-insensitive: a name differing from a column of the table only in
+            # case is stored as name_2, name_3...
+            taken = self._taken[table]
+            sql_name, number = column, 1
+            while taken.get(sql_name.casefold(), sql_name) != sql_name:
+                number += 1
+                sql_name = f'{column}_{number}'
+            taken[sql_name.casefold()] = names[column] = sql_name
+        return sql_name
+
+    def ensure_table(self, table, columns):
+        existing = self.get_table_columns(table)
+        if table not in self._taken:
+            self._taken[table] = {c.casefold(): c for c in existing}
+            self._sql_names[table] = {}
+        columns = [self.get_sql_name(table, c) for c in columns]
+        if not existing:
+            # no declared types: values keep the type the parser gives them
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {quote(table)} '
+                                    f'({", ".join(quote(c) for c in columns)})')
+            return
+        for column in columns:
+            if column not in existing:
+                self.connection.execute(f'ALTER TABLE {quote(table)} ADD COLUMN {quote(column)}')
+
+    def flush(self):
+        if not self._pending_total:
+            return
+        with self.connection:
+            for table, batches in self._rows.items():
+                if not batches:
+                    continue
+                self.ensure_table(table, list(self._columns[table]))
+                sql_names = self._sql_names[table]
+                for names, rows in batches:
+                    self.connection.executemany(
+                        f'INSERT INTO {quote(table)} ({", ".join(quote(sql_names[c]) for c in names)}) '
+                        f'VALUES ({", ".join("?" * len(names))})', rows)
+                batches.clear()
+        self._pending_total = 0
+
+    def create_indexes(self):
+        with self.connection:
+            for table, (keys, times) in self._indexes.items():
+                existing = self.get_table_columns(table)
+                sql_names = self._sql_names.get(table, {})
+                keys = [c for c in (sql_names.get(c, c) for c in keys) if c in existing]
+                times = [c for c in (sql_names.get(c, c) for c in times) if c in existing]
+                specs = []
+                if keys:
+                    # one object over a time window
+                    specs.append(keys + times[:1])
+                specs.extend([t] for t in times)
+                for columns in specs:
+                    name = quote(f'ix_{table}_{"_".join(columns)}')
+                    self.connection.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {quote(table)} '
+                                            f'({", ".join(quote(c) for c in columns)})')
+
+    def close(self):
+        with self.timed():
+            self.flush()
+            self.create_indexes()
+            self.connection.close()
+        logger.info(f'Wrote {self.rows_written} rows to {len(self._columns)} tables in {self.path}')
+
+
+def get_database_path(output_format, write_directory):
+    # sqlite:<path>, or just sqlite for a database in the output directory
+    path = output_format.partition(':')[2]
+    return path or os.path.join(write_directory, default_database)
@@ -0,0 +1,62 @@
+import gzip
+import os
+from common.metrics import TimedReader
+from common.pipeline import ReadAheadStream
+
+xml_extensions = ('.xml', '.gz')
+archive_extensions = ('.tar.gz', '.tgz', '.tar', '.zip')
+input_extensions = xml_extensions + archive_extensions
+
+
+def is_input_name(name, extensions=input_extensions):
+    return not os.path.basename(name).startswith('.') and name.lower().endswith(extensions)
+
+
+def open_input(source, metrics=None):
+    """
+    Open a parser input: a path, gunzipped on the fly when it ends with .gz, or an already open binary
+    stream such as an archive member. With metrics, reads are timed as the decompress or read stage,
+    on a thread reading ahead of the parser when the run is pipelined
+    """
+    if isinstance(source, str) and source.endswith('.gz'):
+        stream, stage = gzip.open(source), 'decompress'
+    elif isinstance(source, str):
+        if metrics is None:
+            return source
+        stream, stage = open(source, 'rb'), 'read'
+    else:
+        stream, stage = source, 'read'
+    if metrics is None:
+        return stream
+    stream = TimedReader(stream, metrics, stage)
+    return ReadAheadStream(stream, metrics) if metrics.pipelined else stream
+
+
+def source_name(source):
+    # file name written to the outputs, the member name for archive members
+    return os.path.basename(source if isinstance(source, str) else getattr(source, 'name', ''))
+
+
+def free_element(elem):
+    """
+    Release a fully processed element for iterparse: clear its content and drop the already
+    processed preceding siblings, so the partially built tree stays bounded by document depth
+    """
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def free_ancestors(elem):
+    """
+    Drop the already processed preceding siblings of every ancestor of elem, for deep trees whose
+    ancestors never reach their own end event while the bulk of the document is parsed
+    """
+    for ancestor in elem.iterancestors():
+        parent = ancestor.getparent()
+        if parent is None:
+            break
+        while ancestor.getprevious() is not None:
+            del parent[0]
@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from multiprocessing import Pool
+from common.batch import check_output_format, parse_file
+from common.detect import detect_format
+from common.manifest import parser_signature
+from common.stream import is_input_name
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+logger = logging.getLogger(__name__)
+
+
+def _ignore_interrupt():
+    # Ctrl+C is handled by the watcher, which lets the workers finish the files they have
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class Watcher:
+    """
+    Long-running ingestion of drop directories. New files are picked up through inotify, or by polling the
+    directories when inotify_simple is not installed, and handed to the parser of their sniffed vendor and
+    type as soon as they are complete: on close-after-write or rename with inotify, once their size and mtime
+    stayed the same for settle_seconds when polling. Files are parsed by a pool of workers keeping their
+    parser instances warm. At most max_pending files are queued to the pool; when the parsers fall behind
+    the watcher stops taking files until a slot frees up, and the rest wait in the drop directory
+    """
+
+    def __init__(self, directories, write_directory, parsers, workers=None, max_pending=None,
+                 poll_interval=1.0, settle_seconds=2.0, rescan_interval=60.0, manifest=None, use_inotify=True,
+                 metrics_path=None):
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.write_directory = write_directory
+        # (vendor, type) -> (parser_class, parser_kwargs)
+        self.parsers = parsers
+        self.workers = workers or os.cpu_count()
+        for _, parser_kwargs in parsers.values():
+            check_output_format(parser_kwargs, self.workers)
+        self.max_pending = max_pending or self.workers * 2
+        self.poll_interval = poll_interval
+        self.settle_seconds = settle_seconds
+        self.rescan_interval = rescan_interval
+        self.manifest = manifest
+        # per-file metrics are appended to this file as JSON lines
+        self.metrics_path = metrics_path
+        self.summary = {'files': 0, 'skipped': 0, 'failed': [], 'rows': 0}
+        self._inotify = None
+        self._watches = {}
+        if use_inotify and INotify is not None:
+            self._inotify = INotify()
+            for directory in self.directories:
+                wd = self._inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO)
+                self._watches[wd] = directory
+        # path -> (size, mtime, time the file was first seen with this size and mtime)
+        self._candidates = {}
+        # path -> (size, mtime) of the version already submitted
+        self._handled = {}
+        self._arrived = {}
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._results = queue.SimpleQueue()
+        self._stop = threading.Event()
+        self._last_scan = 0.0
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        logger.info(f"Watching {', '.join(self.directories)} with {'inotify' if self._inotify else 'polling'}, "
+                    f"{self.workers} workers, {self.max_pending} pending files at most")
+        with Pool(self.workers, initializer=_ignore_interrupt) as pool:
+            try:
+                self.scan()
+                while not self._stop.is_set():
+                    self.dispatch(pool)
+                    self.collect()
+                    self.wait_for_changes()
+            except KeyboardInterrupt:
+                logger.info('Interrupted, waiting for the files being parsed')
+            finally:
+                pool.close()
+                pool.join()
+                self.collect()
+                if self._inotify is not None:
+                    self._inotify.close()
+        return self.summary
+
+    def scan(self):
+        self._last_scan = time.monotonic()
+        present = set()
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                logger.warning(f'Drop directory {directory} does not exist')
+                continue
+            for entry in entries:
+                if is_input_name(entry.name) and entry.is_file():
+                    present.add(entry.path)
+                    self.consider(entry.path)
+        # forget files that were moved away or deleted since they were parsed
+        for path in self._handled.keys() - present:
+            del self._handled[path]
+
+    def consider(self, path, complete=False):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._candidates.pop(path, None)
+            return
+        version = (stat.st_size, stat.st_mtime)
+        if self._handled.get(path) == version:
+            return
+        now = time.monotonic()
+        self._arrived.setdefault(path, time.time())
+        candidate = self._candidates.get(path)
+        if complete:
+            self._candidates[path] = version + (now - self.settle_seconds,)
+        elif candidate is None or candidate[:2] != version:
+            self._candidates[path] = version + (now,)
+
+    def wait_for_changes(self):
+        if self._inotify is None:
+            self._stop.wait(self.poll_interval)
+            self.scan()
+            return
+        if time.monotonic() - self._last_scan >= self.rescan_interval:
+            # safety net for missed events, also prunes the files already handled
+            self.scan()
+        for event in self._inotify.read(timeout=int(self.poll_interval * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                logger.warning('inotify queue overflowed, rescanning the drop directories')
+                self.scan()
+            elif event.wd in self._watches and is_input_name(event.name):
+                self.consider(os.path.join(self._watches[event.wd], event.name), complete=True)
+
+    def dispatch(self, pool):
+        now = time.monotonic()
+        for path, (size, mtime, since) in list(self._candidates.items()):
+            if self._stop.is_set():
+                return
+            if now - since < self.settle_seconds:
+                continue
+            # the file must not have changed since it was last seen
+            self.consider(path)
+            if self._candidates.get(path) != (size, mtime, since):
+                continue
+            del self._candidates[path]
+            self._handled[path] = (size, mtime)
+            self.submit(pool, path)
+
+    def submit(self, pool, path):
+        key = detect_format(path)
+        if key not in self.parsers:
+            logger.warning(f'Skipping {path}: no parser selected for format {key}')
+            self.summary['skipped'] += 1
+            self._arrived.pop(path, None)
+            return
+        parser_class, parser_kwargs = self.parsers[key]
+        signature = parser_signature(parser_class, parser_kwargs)
+        if self.manifest is not None and self.manifest.is_done(path, signature):
+            logger.info(f'Skipping {path}: already parsed')
+            self.summary['skipped'] += 1
+            self._arrived.pop(path, None)
+            return
+        # back-pressure: wait for a free slot, collecting finished files meanwhile
+        while not self._slots.acquire(timeout=self.poll_interval):
+            self.collect()
+        task = (parser_class, parser_kwargs, path, self.write_directory)
+        pool.apply_async(parse_file, (task,), callback=lambda result: self.finished(signature, result),
+                         error_callback=lambda ex: self.finished(signature, (path, 0, 0.0, repr(ex), [], None)))
+
+    def finished(self, signature, result):
+        # runs in the pool's result thread, the manifest is only touched from the watcher thread
+        self._results.put((signature, result))
+        self._slots.release()
+
+    def collect(self):
+        while True:
+            try:
+                signature, (path, rows, elapsed, error, outputs, metrics) = self._results.get_nowait()
+            except queue.Empty:
+                return
+            latency = time.time() - self._arrived.pop(path, time.time())
+            self.summary['files'] += 1
+            if error is not None:
+                self.summary['failed'].append((path, error))
+                logger.error(f'Failed {path}: {error}')
+                continue
+            if self.manifest is not None:
+                self.manifest.record(path, signature, outputs, rows)
+            self.summary['rows'] += rows
+            if self.metrics_path is not None:
+                metrics['latency'] = round(latency, 3)
+                with open(self.metrics_path, 'a') as f:
+                    f.write(json.dumps(metrics) + '\n')
+            logger.info(f'{path}: {rows} rows in {elapsed:.2f}s, {latency:.1f}s after it arrived')
@@ -0,0 +1 @@
+# the tests import the parser packages from the repository root
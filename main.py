@@ -1,36 +1,303 @@
 import argparse
-from Nokia.cm.parse_cm import Nokia_CM
-from Erikson.cm.parse_cm import *
-from Huawei.pm.parse_pm import Huawei_PM
-from Nokia.pm.parse_pm import Nokia_PM
-from Erikson.pm.parse_pm import Ericsson_PM
+import json
+import logging
+import os
+import signal
+from common.registry import get_parser_class, parser_classes
+from common.sink import output_formats
+from common.stream import archive_extensions
+
+# parser modules and their dependencies are only imported for the vendor and type being parsed
+pm_keys = {key for key in parser_classes if key[1] == 'pm'}
+cm_keys = {key for key in parser_classes if key[1] == 'cm'}
+
+
+def read_selection(values, separator=','):
+    """
+    Names given on the command line, separated by separator (None: one name per value) or as @file lists
+    with one name per line
+    """
+    from common.batch import read_file_list
+    selection = []
+    for value in values or []:
+        if value.startswith('@'):
+            selection.extend(read_file_list(value[1:]))
+        else:
+            names = value.split(separator) if separator else [value]
+            selection.extend(name.strip() for name in names if name.strip())
+    return selection
+
+
+def get_parser_kwargs(key, args):
+    parser_kwargs = {'output_format': args.output_format}
+    if args.wide and key == ('ericsson', 'pm'):
+        parser_kwargs['wide'] = True
+    if (args.counters or args.measurements) and key in pm_keys:
+        parser_kwargs['counters'] = read_selection(args.counters)
+        # Ericsson measInfoIds are DNs with commas of their own
+        parser_kwargs['measurements'] = read_selection(args.measurements, separator=None)
+    if (args.rollup or args.rollup_rules) and key in pm_keys:
+        from common.rollup import read_rules
+        parser_kwargs['rollup'] = read_rules(args.rollup_rules) if args.rollup_rules else {}
+    if args.delta and key in cm_keys:
+        parser_kwargs['delta'] = args.delta
+    if args.mo_ids and key in pm_keys:
+        parser_kwargs['mo_ids'] = True
+    if args.split_workers and key in (('ericsson', 'cm'), ('nokia', 'cm'), ('ericsson', 'pm')):
+        parser_kwargs['split_workers'] = args.split_workers
+    if args.classes and key == ('nokia', 'cm'):
+        parser_kwargs['classes'] = read_selection(args.classes)
+    if args.offset_index and (key in pm_keys or key == ('nokia', 'cm')):
+        parser_kwargs['offset_index'] = os.path.abspath(args.offset_index_dir) if args.offset_index_dir else True
+    if args.pipeline:
+        parser_kwargs['pipeline'] = True
+    return parser_kwargs
+
+
+def watch(args, manifest):
+    from common.watch import Watcher
+    # with --vendor and/or --type only the matching formats are parsed, otherwise every format detected
+    selected = {key: (get_parser_class(key), get_parser_kwargs(key, args)) for key in parser_classes
+                if args.vendor in (None, key[0]) and args.type in (None, key[1])}
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    logging.getLogger('common.watch').setLevel(logging.INFO)
+    watcher = Watcher(args.watch, args.path_to_directory, selected, workers=args.workers,
+                      max_pending=args.max_pending, poll_interval=args.poll_interval,
+                      settle_seconds=args.settle, manifest=manifest, metrics_path=args.metrics)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    summary = watcher.run()
+    print(f"Parsed {summary['files']} files ({len(summary['failed'])} failed, {summary['skipped']} skipped), "
+          f"{summary['rows']} rows")
+
+
+def serve(args):
+    from common.server import ParseServer
+    # workers import the parsers of --vendor/--type up front, or of every format when they are left out
+    preload = [key for key in parser_classes if args.vendor in (None, key[0]) and args.type in (None, key[1])]
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    logging.getLogger('common.server').setLevel(logging.INFO)
+    ParseServer(args.serve, workers=args.workers, preload=preload).serve()
+
+
+def send(args, parser_kwargs):
+    """
+    Hand --path_to_file to the parse server of --server; the server resolves nothing against its own working
+    directory, paths are sent absolute
+    """
+    from common.client import send_job
+    from common.manifest import manifest_filename
+    manifest = None
+    if not args.no_manifest:
+        manifest = os.path.abspath(args.manifest or os.path.join(args.path_to_directory, manifest_filename))
+    if 'delta' in parser_kwargs:
+        parser_kwargs['delta'] = os.path.abspath(parser_kwargs['delta'])
+    if parser_kwargs['output_format'].startswith('sqlite:'):
+        parser_kwargs['output_format'] = 'sqlite:' + os.path.abspath(parser_kwargs['output_format'][7:])
+    result = send_job(args.server, {
+        'vendor': args.vendor, 'type': args.type, 'path': os.path.abspath(args.path_to_file),
+        'write_directory': os.path.abspath(args.path_to_directory), 'parser_kwargs': parser_kwargs,
+        'manifest': manifest, 'force': args.force})
+    if result.get('skipped'):
+        print(f"Skipping {args.path_to_file}: already parsed, use --force to parse it again")
+        return None
+    if result.get('error') is not None:
+        raise SystemExit(f"Failed {args.path_to_file}: {result['error']}")
+    from common.metrics import aggregate
+    file_metrics = result['metrics']
+    file_metrics['file'] = args.path_to_file
+    return {'files': [file_metrics], 'batch': aggregate([file_metrics])}
 
 
 def main():
     parser = argparse.ArgumentParser(description="Example script with command line arguments")
 
-    parser.add_argument("--vendor", required=True, help="Vendor (Ericsson, Huawei, or Nokia)")
-    parser.add_argument("--type", required=True, choices=["cm", "pm"], help="Type (cm or pm)")
-    parser.add_argument("--path_to_file", required=True, help="The path to the file")
-    parser.add_argument("--path_to_directory", required=True, help="Path to directory")
+    parser.add_argument("--vendor", help="Vendor (Ericsson, Huawei, or Nokia), optional with --watch")
+    parser.add_argument("--type", choices=["cm", "pm"], help="Type (cm or pm), optional with --watch")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--path_to_file", help="The path to the file, or to a .tar.gz/.tgz/.tar/.zip bundle of files")
+    source.add_argument("--batch", nargs="+",
+                        help="Directories, glob patterns or @file lists to parse in parallel")
+    source.add_argument("--watch", nargs="+",
+                        help="Drop directories to watch: every new file is parsed as soon as it is complete, "
+                             "with the parser of its detected vendor and type")
+    source.add_argument("--serve", metavar="SOCKET",
+                        help="Run a parse server on this Unix socket, taking the --path_to_file jobs of clients "
+                             "started with --server; --vendor/--type select the parsers loaded up front")
+    source.add_argument("--compact", nargs="*", metavar="TABLE",
+                        help="Merge the part files written to --path_to_directory with --output-format csv-shards "
+                             "into one sorted {table}.csv per table, of every table or the given ones")
+    parser.add_argument("--server", metavar="SOCKET",
+                        help="--path_to_file: have the parse server listening on this Unix socket parse the file, "
+                             "instead of loading the parser in this process")
+    parser.add_argument("--workers", type=int,
+                        help="Number of worker processes for --batch and --watch (default: all cores)")
+    parser.add_argument("--split-workers", type=int,
+                        help="--path_to_file, Ericsson/Nokia CM and Ericsson PM: parse one uncompressed file in "
+                             "this many worker processes, split into byte ranges of whole MOs/measInfos. Files under 64 MB "
+                             "are parsed in a single process, the workers would cost more than they save")
+    parser.add_argument("--max-pending", type=int,
+                        help="--watch: files queued to the workers at most (default: twice the workers)")
+    parser.add_argument("--poll-interval", type=float, default=1.0,
+                        help="--watch: seconds between directory scans when inotify is not available")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="--watch: seconds a polled file must stay unchanged before it is parsed")
+    parser.add_argument("--path_to_directory", help="Path to directory, required except with --serve")
+    parser.add_argument("--output-format", choices=output_formats,
+                        help="Output format: row-oriented csv, csv-shards for one part file per table and run "
+                             "(safe with any number of processes writing to the output directory, merged by "
+                             "--compact), columnar parquet/feather, or sqlite for a parsed.sqlite database in "
+                             "the output directory. Default: csv for --path_to_file, csv-shards for --batch, "
+                             "--watch and --server, whose files are parsed by several processes at once")
+    parser.add_argument("--output",
+                        help="sqlite:<path>: write all tables to this SQLite database instead of the output "
+                             "directory, with indexes on the MO and time columns")
+    parser.add_argument("--wide", action="store_true",
+                        help="Ericsson PM only: one row per measObjLdn with one column per counter")
+    parser.add_argument("--manifest",
+                        help="Ingestion manifest used to skip already parsed files "
+                             "(default: .manifest.sqlite in the output directory)")
+    parser.add_argument("--no-manifest", action="store_true", help="Do not read or record the manifest")
+    parser.add_argument("--force", action="store_true",
+                        help="Parse the given files again even if the manifest has them as done")
+    parser.add_argument("--metrics",
+                        help="Write stage timings, rows/s and peak memory per file and for the run as JSON "
+                             "to this file (--watch: one JSON line per file)")
+    parser.add_argument("--rollup", action="store_true",
+                        help="PM only: also aggregate the counters per MO into hours and days, updated with every "
+                             "parsed file, under rollup/ in the output directory")
+    parser.add_argument("--rollup-rules",
+                        help="PM only, implies --rollup: CSV of counter,aggregation lines (sum, avg, min or max; "
+                             "* for the default, otherwise sum)")
+    parser.add_argument("--delta",
+                        help="CM only: snapshot index of the previous dump (created on the first run); only the "
+                             "added, modified and removed MOs are written, with a Change column. "
+                             "The file must be a single dump, not an archive")
+    parser.add_argument("--mo-ids", action="store_true",
+                        help="PM only: write an integer MO_ID per row instead of the MO DN and its components, "
+                             "which are written once per MO to the MO table")
+    parser.add_argument("--counters", nargs="+",
+                        help="PM only: counters to keep (names, comma separated or @file)")
+    parser.add_argument("--measurements", nargs="+",
+                        help="PM only: measInfo ids, measurement types or output tables to keep "
+                             "(space separated or @file, not comma separated: Ericsson measInfo ids such as "
+                             "PM=1,PmGroup=Group4 have commas)")
+
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Read/decompress, parse and write each file on three threads connected by bounded "
+                             "queues; --metrics then reports the utilization of each stage")
+    parser.add_argument("--classes", nargs="+",
+                        help="Nokia CM only: managedObject classes to keep (comma separated or @file)")
+    parser.add_argument("--offset-index", action="store_true",
+                        help="With --measurements (PM) or --classes (Nokia CM): read only the selected elements "
+                             "of uncompressed files, through an index of their byte offsets (built on first use)")
+    parser.add_argument("--offset-index-dir",
+                        help="Directory of the --offset-index indexes (default: .offsets in the output directory)")
 
     args = parser.parse_args()
 
-    if args.vendor == "ericsson":
-        if args.type == 'cm':
-            Ericsson_CM().run(args.path_to_file,args.path_to_directory)
-        elif args.type == 'pm':
-            Ericsson_PM().run(args.path_to_file,args.path_to_directory)
-    elif args.vendor == "nokia":
-        if args.type == 'cm':
-            Nokia_CM().run(args.path_to_file,args.path_to_directory)
-        elif args.type == 'pm':
-            Nokia_PM().run(args.path_to_file,args.path_to_directory)
-    elif args.vendor == "huawei":
-        if args.type == 'pm':
-            Huawei_PM().run(args.path_to_file,args.path_to_directory)
-    else:
-        print("Invalid supplier. Valid values: Ericsson, Huawei, Nokia")
+    if args.serve:
+        serve(args)
+        return
+    if not args.path_to_directory:
+        parser.error("--path_to_directory is required")
+    if args.compact is not None:
+        from common.compact import compact
+        summary = compact(args.path_to_directory, args.compact)
+        print(f"Compacted {sum(parts for parts, _ in summary.values())} part files into {len(summary)} tables, "
+              f"{sum(rows for _, rows in summary.values())} rows")
+        return
+    if args.server and not args.path_to_file:
+        parser.error("--server is only supported with --path_to_file")
+    if args.output:
+        if not args.output.startswith('sqlite:') or args.output == 'sqlite:':
+            parser.error("--output must be sqlite:<path>")
+        args.output_format = args.output
+    if args.output_format is None:
+        args.output_format = 'csv' if args.path_to_file and not args.server else 'csv-shards'
+    if args.output_format == 'csv' and (args.batch or args.watch) and (args.workers or os.cpu_count()) > 1:
+        parser.error("--output-format csv cannot be written by several workers at once, "
+                     "use csv-shards or --workers 1")
+    # with --watch the vendor and type may be left out, the options then apply to the parsers supporting them
+    if args.wide and (args.vendor not in (None, 'ericsson') or args.type == 'cm'):
+        parser.error("--wide is only supported for --vendor ericsson --type pm")
+    if (args.counters or args.measurements) and args.type == 'cm':
+        parser.error("--counters and --measurements are only supported for --type pm")
+    if (args.rollup or args.rollup_rules) and args.type == 'cm':
+        parser.error("--rollup is only supported for --type pm")
+    if args.classes and (args.vendor not in (None, 'nokia') or args.type == 'pm'):
+        parser.error("--classes is only supported for --vendor nokia --type cm")
+    if args.classes and args.delta:
+        parser.error("--delta compares whole dumps, --classes cannot be used with it")
+    if args.mo_ids and args.type == 'cm':
+        parser.error("--mo-ids is only supported for --type pm")
+    if args.offset_index_dir and not args.offset_index:
+        parser.error("--offset-index-dir is only used with --offset-index")
+    # pool workers cannot start pools of their own
+    if args.split_workers and not args.path_to_file:
+        parser.error("--split-workers is only supported with --path_to_file")
+    if args.split_workers and args.server:
+        parser.error("--split-workers cannot be used with --server, whose files are parsed by pool workers")
+    # the MOs missing from the parsed file are reported as removed: the file must be a whole snapshot
+    if args.delta and (args.type != 'cm' or not args.path_to_file):
+        parser.error("--delta is only supported for --type cm with --path_to_file")
+    if args.delta and args.path_to_file.lower().endswith(archive_extensions):
+        parser.error("--delta compares one dump with the previous one, archives of several dumps are not supported")
+    if not args.watch:
+        key = (args.vendor, args.type)
+        if key not in parser_classes:
+            print("Invalid supplier. Valid values: Ericsson, Huawei, Nokia")
+            return
+        parser_kwargs = get_parser_kwargs(key, args)
+    if args.server:
+        metrics = send(args, parser_kwargs)
+        if args.metrics and metrics is not None:
+            with open(args.metrics, 'w') as f:
+                json.dump(metrics, f, indent=2)
+        return
+
+    from common.manifest import Manifest, manifest_filename, parser_signature
+    from common.metrics import aggregate
+    manifest = None
+    if not args.no_manifest:
+        manifest = Manifest(args.manifest or os.path.join(args.path_to_directory, manifest_filename))
+    try:
+        if args.watch:
+            watch(args, manifest)
+        elif args.batch:
+            from common.batch import collect_files, run_batch
+            files = collect_files(args.batch)
+            parser_class = get_parser_class(key)
+            summary = run_batch(parser_class, files, args.path_to_directory, workers=args.workers,
+                                parser_kwargs=parser_kwargs, manifest=manifest, force=args.force)
+            print(f"Parsed {summary['files']} files ({len(summary['failed'])} failed, {summary['skipped']} skipped "
+                  f"as already parsed) with {summary['workers']} workers in {summary['seconds']:.1f}s: "
+                  f"{summary['files_per_sec']:.2f} files/s, {summary['rows']} rows, {summary['rows_per_sec']:.0f} rows/s")
+            for path, error in summary['failed']:
+                print(f"Failed {path}: {error}")
+            if args.output_format == 'csv-shards':
+                print(f"Merge the part files into one CSV per table with --compact --path_to_directory "
+                      f"{args.path_to_directory}")
+            metrics = summary['metrics']
+        else:
+            from common.archive import run_parser
+            parser_class = get_parser_class(key)
+            signature = parser_signature(parser_class, parser_kwargs)
+            if manifest is not None and not args.force and manifest.is_done(args.path_to_file, signature):
+                print(f"Skipping {args.path_to_file}: already parsed, use --force to parse it again")
+                return
+            instance = parser_class(**parser_kwargs)
+            rows = run_parser(instance, args.path_to_file, args.path_to_directory)
+            if manifest is not None:
+                manifest.record(args.path_to_file, signature, instance.outputs, rows or 0)
+            file_metrics = instance.metrics.summary()
+            file_metrics['file'] = args.path_to_file
+            metrics = {'files': [file_metrics], 'batch': aggregate([file_metrics])}
+        if args.metrics and not args.watch:
+            with open(args.metrics, 'w') as f:
+                json.dump(metrics, f, indent=2)
+    finally:
+        if manifest is not None:
+            manifest.close()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
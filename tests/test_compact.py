@@ -0,0 +1,50 @@
+import csv
+import os
+
+from common.compact import compact
+from common.sink import ShardedCsvSink
+
+
+def write_part(write_directory, rows, fieldnames=('time', 'cell', 'value')):
+    with ShardedCsvSink(str(write_directory)) as sink:
+        sink.write('pm', list(fieldnames), rows, keys=('cell',), times=('time',))
+
+
+def read_table(path):
+    with open(path, newline='') as f:
+        return list(csv.reader(f))
+
+
+def test_compact_merges_sorted(tmp_path):
+    write_part(tmp_path, [{'time': '11:00', 'cell': '1', 'value': '3'}, {'time': '10:00', 'cell': '2', 'value': '2'}])
+    write_part(tmp_path, [{'time': '10:00', 'cell': '1', 'value': '1'}])
+    assert compact(str(tmp_path)) == {'pm': (2, 3)}
+    assert read_table(tmp_path / 'pm.csv') == [['time', 'cell', 'value'], ['10:00', '1', '1'], ['10:00', '2', '2'],
+                                               ['11:00', '1', '3']]
+    assert sorted(os.listdir(tmp_path / 'pm')) == ['.lock', 'keys.json']
+
+
+def test_compact_is_idempotent(tmp_path):
+    write_part(tmp_path, [{'time': '10:00', 'cell': '1', 'value': '1'}])
+    compact(str(tmp_path))
+    compacted = read_table(tmp_path / 'pm.csv')
+    assert compact(str(tmp_path)) == {}
+    assert read_table(tmp_path / 'pm.csv') == compacted
+
+
+def test_compact_merges_new_parts_and_columns(tmp_path):
+    write_part(tmp_path, [{'time': '11:00', 'cell': '1', 'value': '3'}])
+    compact(str(tmp_path))
+    write_part(tmp_path, [{'time': '10:00', 'cell': '1', 'value': '1', 'extra': 'x'}],
+               ('time', 'cell', 'value', 'extra'))
+    assert compact(str(tmp_path)) == {'pm': (1, 1)}
+    assert read_table(tmp_path / 'pm.csv') == [['time', 'cell', 'value', 'extra'], ['10:00', '1', '1', 'x'],
+                                               ['11:00', '1', '3', '']]
+
+
+def test_compact_finishes_interrupted_compaction(tmp_path):
+    write_part(tmp_path, [{'time': '10:00', 'cell': '1', 'value': '1'}])
+    # a merged file left without journal was written before the commit point, the parts are merged again
+    (tmp_path / 'pm' / 'merged.compact.tmp').write_text('time,cell,value\n')
+    assert compact(str(tmp_path)) == {'pm': (1, 1)}
+    assert read_table(tmp_path / 'pm.csv') == [['time', 'cell', 'value'], ['10:00', '1', '1']]
@@ -0,0 +1,93 @@
+import csv
+import os
+import zipfile
+
+import pytest
+
+from Erikson.cm.parse_cm import Ericsson_CM
+from common.archive import run_parser
+from common.delta import SnapshotIndex
+
+cell = '''<xn:VsDataContainer id="{id}">
+<xn:attributes>
+<xn:vsDataType>vsDataEUtranCellFDD</xn:vsDataType>
+<es:vsDataEUtranCellFDD>
+<es:cellId>{id}</es:cellId>
+<es:earfcndl>{earfcn}</es:earfcndl>
+</es:vsDataEUtranCellFDD>
+</xn:attributes>
+</xn:VsDataContainer>'''
+
+dump = '''<?xml version="1.0" encoding="UTF-8"?>
+<bulkCmConfigDataFile xmlns="configData.xsd" xmlns:xn="genericNrm.xsd" xmlns:es="EricssonSpecificAttributes.xsd">
+<configData dnPrefix="Undefined">
+<xn:SubNetwork id="ROOT">
+<xn:MeContext id="SITE1">
+<xn:ManagedElement id="1">
+{cells}
+</xn:ManagedElement>
+</xn:MeContext>
+</xn:SubNetwork>
+</configData>
+</bulkCmConfigDataFile>
+'''
+
+
+def write_dump(path, cells):
+    with open(path, 'w') as f:
+        f.write(dump.format(cells='\n'.join(cell.format(id=i, earfcn=e) for i, e in cells.items())))
+    return path
+
+
+def read_changes(write_directory):
+    with open(os.path.join(write_directory, 'EUtranCellFDD.csv'), newline='') as f:
+        return {row['cellId'] or row['DN'].rsplit('=', 1)[-1]: row for row in csv.DictReader(f)}
+
+
+def test_snapshot_index(tmp_path):
+    path = str(tmp_path / 'snapshot.sqlite')
+    index = SnapshotIndex(path, 'DN')
+    assert index.get_delta('Cell', {'DN': 'a', 'x': '1'}) == {'DN': 'a', 'x': '1', 'Change': 'added'}
+    assert index.get_delta('Cell', {'DN': 'b', 'x': '1'})['Change'] == 'added'
+    assert index.get_delta('Cell', {'DN': 'c', 'x': '1'})['Change'] == 'added'
+    assert index.removed() == []
+    index.commit()
+
+    index = SnapshotIndex(path, 'DN')
+    assert index.get_delta('Cell', {'DN': 'a', 'x': '1'}) is None
+    delta = index.get_delta('Cell', {'DN': 'b', 'x': '2', 'y': '3'})
+    assert delta == {'DN': 'b', 'Change': 'modified', 'ChangedParameters': 'x;y', 'x': '2', 'y': '3'}
+    assert index.removed() == [('Cell', {'DN': 'c', 'Change': 'removed'})]
+    index.commit()
+    assert dict(index.counts) == {'unchanged': 1, 'modified': 1, 'removed': 1}
+
+
+def test_delta_of_consecutive_dumps(tmp_path):
+    snapshot = str(tmp_path / 'snapshot.sqlite')
+    first = write_dump(tmp_path / 'first.xml', {1: 100, 2: 200, 3: 300})
+    Ericsson_CM(delta=snapshot).run(str(first), str(tmp_path / 'out1'))
+    changes = read_changes(tmp_path / 'out1')
+    assert {k: row['Change'] for k, row in changes.items()} == {'1': 'added', '2': 'added', '3': 'added'}
+
+    second = write_dump(tmp_path / 'second.xml', {1: 100, 2: 250, 4: 400})
+    parser = Ericsson_CM(delta=snapshot)
+    parser.run(str(second), str(tmp_path / 'out2'))
+    changes = read_changes(tmp_path / 'out2')
+    assert {k: row['Change'] for k, row in changes.items()} == {'2': 'modified', '4': 'added', '3': 'removed'}
+    assert changes['2']['ChangedParameters'] == 'earfcndl'
+    assert changes['2']['earfcndl'] == '250'
+
+    # the same dump again has no changes
+    parser.run(str(second), str(tmp_path / 'out3'))
+    assert not os.path.exists(tmp_path / 'out3' / 'EUtranCellFDD.csv')
+
+
+def test_delta_of_archive_is_refused(tmp_path):
+    xml = write_dump(tmp_path / 'dump.xml', {1: 100})
+    archive = tmp_path / 'dumps.zip'
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.write(xml, 'dump.xml')
+    snapshot = tmp_path / 'snapshot.sqlite'
+    with pytest.raises(ValueError):
+        run_parser(Ericsson_CM(delta=str(snapshot)), str(archive), str(tmp_path / 'out'))
+    assert not snapshot.exists()
@@ -0,0 +1,32 @@
+import csv
+import json
+import os
+
+import pytest
+
+from common.sink import ShardedCsvSink
+
+
+def write_rows(sink, table, rows):
+    sink.write(table, ['time', 'cell', 'value'], rows, keys=('cell',), times=('time',))
+
+
+def test_sharded_close_publishes_parts(tmp_path):
+    with ShardedCsvSink(str(tmp_path)) as sink:
+        write_rows(sink, 'pm', [{'time': '10:00', 'cell': '2', 'value': '5'}])
+        write_rows(sink, 'pm', [{'time': '10:00', 'cell': '1', 'value': '7'}])
+    assert sink.outputs == [str(tmp_path / 'pm' / f'part-{sink.shard}.csv')]
+    assert sorted(os.listdir(tmp_path / 'pm')) == ['keys.json', f'part-{sink.shard}.csv']
+    with open(sink.outputs[0], newline='') as f:
+        assert list(csv.reader(f)) == [['time', 'cell', 'value'], ['10:00', '2', '5'], ['10:00', '1', '7']]
+    with open(tmp_path / 'pm' / 'keys.json') as f:
+        assert json.load(f) == {'times': ['time'], 'keys': ['cell']}
+
+
+def test_sharded_abort_removes_parts(tmp_path):
+    with pytest.raises(RuntimeError):
+        with ShardedCsvSink(str(tmp_path), flush_rows=2) as sink:
+            write_rows(sink, 'pm', [{'time': '10:00', 'cell': str(i), 'value': '1'} for i in range(5)])
+            assert os.path.isfile(tmp_path / 'pm' / f'part-{sink.shard}.csv.part')
+            raise RuntimeError('parse failed')
+    assert os.listdir(tmp_path / 'pm') == []